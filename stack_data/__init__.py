@@ -1,7 +1,10 @@
 from .core import Source, FrameInfo, markers_from_ranges, Options, LINE_GAP, Line, Variable, RangeInLine, \
-    RepeatedFrames, MarkerInLine, style_with_executing_node, BlankLineRange, BlankLines
+    RepeatedFrames, MarkerInLine, style_with_executing_node, BlankLineRange, BlankLines, SourceCache, \
+    VariableSelection, FrozenOptions, ElidedFrames, HiddenFrames
 from .formatting import Formatter
+from .frame_filter import FrameFilter
 from .serializing import Serializer
+from .snapshot import FrameSnapshot, ExceptionSnapshot
 
 try:
     from .version import __version__
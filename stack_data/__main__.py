@@ -0,0 +1,88 @@
+"""
+Pre-populates a stack_data DiskCache, e.g. as part of a deployment, so that
+the first traceback rendered by each fresh process doesn't pay for analysing its source files:
+
+    python -m stack_data --cache-dir /path/to/cache my_package other_package
+
+With no package names, every module in sys.modules is cached.
+The cache directory defaults to the STACK_DATA_CACHE_DIR environment variable.
+"""
+
+import argparse
+import importlib
+import inspect
+import os
+import sys
+from typing import Iterator, Iterable
+
+from stack_data.disk_cache import DiskCache
+
+
+def module_filenames(module, *, submodules: bool) -> Iterator[str]:
+    """
+    The Python source file of a module,
+    and of all its submodules if it's a package and submodules is true.
+    """
+    try:
+        filename = inspect.getsourcefile(module)
+    except (TypeError, AttributeError):
+        filename = None
+    if filename:
+        yield os.path.abspath(filename)
+
+    if not submodules:
+        return
+
+    for path in getattr(module, "__path__", None) or ():
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = [d for d in dirnames if d != "__pycache__"]
+            for name in filenames:
+                if name.endswith(".py"):
+                    yield os.path.abspath(os.path.join(dirpath, name))
+
+
+def package_filenames(names: Iterable[str]) -> Iterator[str]:
+    for name in names:
+        try:
+            module = importlib.import_module(name)
+        except Exception as e:
+            print("Failed to import {}: {!r}".format(name, e), file=sys.stderr)
+            continue
+        yield from module_filenames(module, submodules=True)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m stack_data",
+        description="Pre-populate the stack_data disk cache of source analysis.",
+    )
+    parser.add_argument(
+        "packages", nargs="*",
+        help="Names of packages or modules to cache. Defaults to everything in sys.modules.",
+    )
+    parser.add_argument(
+        "--cache-dir", default=os.environ.get("STACK_DATA_CACHE_DIR"),
+        help="The cache directory. Defaults to $STACK_DATA_CACHE_DIR.",
+    )
+    args = parser.parse_args(argv)
+    if not args.cache_dir:
+        parser.error("--cache-dir is required if STACK_DATA_CACHE_DIR isn't set")
+
+    if args.packages:
+        filenames = package_filenames(args.packages)
+    else:
+        # Submodules that have been imported are in sys.modules themselves
+        filenames = (
+            filename
+            for module in list(sys.modules.values())
+            for filename in module_filenames(module, submodules=False)
+        )
+
+    cache = DiskCache(args.cache_dir)
+    count = cache.warm(dict.fromkeys(filenames))
+    print("Cached {} files in {}".format(count, cache.directory))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
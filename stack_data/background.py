@@ -0,0 +1,123 @@
+import atexit
+import os
+import sys
+import threading
+import traceback
+from collections import deque
+from typing import Callable, Optional
+
+from stack_data.utils import assert_
+
+OVERFLOW_POLICIES = ("drop_new", "drop_old", "block")
+
+
+class BackgroundWorker:
+    """
+    A daemon thread that runs tasks such as rendering tracebacks from a bounded queue,
+    used by Formatter.print_exception(background=True) and Formatter.set_hook(background=True).
+
+    - max_queue: the maximum number of tasks waiting to run.
+    - overflow: what to do when a task is submitted while the queue is full:
+        - "drop_new": discard the new task.
+        - "drop_old": discard the oldest waiting task.
+        - "block": wait until there's space in the queue.
+      The number of discarded tasks is counted in .dropped.
+    - flush_timeout: when the process exits, wait up to this many seconds
+        for the remaining tasks to finish.
+
+    The thread is only started when the first task is submitted.
+    In a child process created by os.fork(), the worker starts a new thread
+    and discards the tasks that were still waiting in the parent.
+    """
+
+    def __init__(self, *, max_queue: int = 100, overflow: str = "drop_new", flush_timeout: float = 5.0):
+        assert_(
+            overflow in OVERFLOW_POLICIES,
+            ValueError("overflow must be one of {}".format(", ".join(OVERFLOW_POLICIES))),
+        )
+        assert_(max_queue > 0, ValueError("max_queue must be positive"))
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.flush_timeout = flush_timeout
+        self.dropped = 0
+        self._tasks = deque()
+        self._pending = 0  # Waiting or running
+        self._condition = threading.Condition()
+        self._thread = None  # type: Optional[threading.Thread]
+        self._pid = os.getpid()
+        self._atexit_registered = False
+
+    def __repr__(self):
+        return "{}(max_queue={!r}, overflow={!r})".format(type(self).__name__, self.max_queue, self.overflow)
+
+    def submit(self, task: Callable[[], None]) -> bool:
+        """
+        Queues the task to be run in the background thread.
+        Returns False if it was dropped because the queue is full.
+        """
+        self._reset_after_fork()
+        with self._condition:
+            self._ensure_started()
+            while len(self._tasks) >= self.max_queue:
+                if self.overflow == "drop_new":
+                    self.dropped += 1
+                    return False
+                elif self.overflow == "drop_old":
+                    self._tasks.popleft()
+                    self._pending -= 1
+                    self.dropped += 1
+                else:
+                    self._condition.wait()
+
+            self._tasks.append(task)
+            self._pending += 1
+            self._condition.notify_all()
+        return True
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits until all submitted tasks have finished, or until the timeout in seconds has passed.
+        Returns True if there are no more tasks.
+        """
+        self._reset_after_fork()
+        with self._condition:
+            return self._condition.wait_for(lambda: self._pending == 0, timeout)
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+
+        self._thread = threading.Thread(target=self._run, name="stack_data-background", daemon=True)
+        self._thread.start()
+        if not self._atexit_registered:
+            self._atexit_registered = True
+            atexit.register(self.flush, self.flush_timeout)
+
+    def _reset_after_fork(self):
+        if self._pid == os.getpid():
+            return
+
+        # Only the thread that called fork() exists in the child,
+        # and the lock may have been held by the worker thread at the time.
+        self._pid = os.getpid()
+        self._tasks = deque()
+        self._pending = 0
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._tasks)
+                task = self._tasks.popleft()
+                # Wake up any submitters blocked on a full queue
+                self._condition.notify_all()
+
+            try:
+                task()
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+            finally:
+                with self._condition:
+                    self._pending -= 1
+                    self._condition.notify_all()
@@ -2,7 +2,11 @@ import ast
 import html
 import os
 import sys
-from collections import defaultdict, Counter
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, Counter, OrderedDict, ChainMap, deque
+from collections.abc import Mapping as MappingABC
 from enum import Enum
 from textwrap import dedent
 from types import FrameType, CodeType, TracebackType
@@ -10,16 +14,21 @@ from typing import (
     Iterator, List, Tuple, Optional, NamedTuple,
     Any, Iterable, Callable, Union,
     Sequence)
-from typing import Mapping
+from typing import Mapping, Dict
 
 import executing
+from asttokens import ASTTokens
+from asttokens.line_numbers import LineNumbers
 from asttokens.util import Token
 from executing import only
-from pure_eval import Evaluator, is_expression_interesting
+from pure_eval import Evaluator, CannotEval, is_expression_interesting
 from stack_data.utils import (
     truncate, unique_in_order, line_range,
-    frame_and_lineno, iter_stack, collapse_repeated, group_by_key_func,
-    cached_property, is_frame, _pygmented_with_ranges, assert_)
+    frame_and_lineno, iter_stack, collapse_repeated, collapse_repeated_streaming, group_by_key_func,
+    cached_property, is_frame, _pygmented_with_ranges, assert_, LRUCache,
+    node_structure)
+from stack_data.disk_cache import DiskCache, CacheEntry
+from stack_data.snapshot import FrameSnapshot
 
 RangeInLine = NamedTuple('RangeInLine',
                          [('start', int),
@@ -62,6 +71,18 @@ class BlankLines(Enum):
     VISIBLE = 2
     SINGLE=3
 
+
+class VariableSelection(Enum):
+    """Which nodes FrameInfo.variables evaluates:
+    SCOPE: all expressions in the frame's scope (FrameInfo.scope)
+    LINES: only expressions in the lines returned by FrameInfo.lines
+    EXECUTING_PIECE: only expressions in FrameInfo.executing_piece
+    """
+    SCOPE = 1
+    LINES = 2
+    EXECUTING_PIECE = 3
+
+
 class Variable(
     NamedTuple('_Variable',
                [('name', str),
@@ -79,6 +100,272 @@ class Variable(
     __eq__ = object.__eq__
 
 
+class SourceCache:
+    """
+    The cache of Source objects used by Source.for_filename, Source.for_frame and Source.executing,
+    which is available as Source.cache.
+
+    By default it's unbounded, so every file that ever appears in a traceback stays in memory
+    along with its AST, tokens, pieces, etc. In long running processes you can bound it with:
+
+        Source.cache = SourceCache(max_entries=100, max_bytes=200 * 1024 * 1024)
+
+    Subclasses of Source share this cache, but each class has its own entries.
+    The least recently used sources are evicted when either limit is exceeded.
+    max_bytes is compared to a rough estimate of the memory used by each source,
+    which grows as more of it is computed.
+    Sources of modules which have been removed from sys.modules are also evicted.
+
+    The attributes hits, misses and evictions count what has happened so far,
+    which can help to choose the limits.
+    """
+
+    def __init__(self, max_entries: Optional[int] = None, max_bytes: Optional[int] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._sources = OrderedDict()  # type: OrderedDict[Tuple[type, str, Sequence[str]], Source]
+        self._sizes = {}  # type: Dict[Tuple[type, str, Sequence[str]], int]
+        self._module_names = {}  # type: Dict[Tuple[type, str, Sequence[str]], str]
+        self._keys = {}  # type: Dict[int, Tuple[type, str, Sequence[str]]]
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._sources)
+
+    def __repr__(self):
+        return (
+            "<{self.__class__.__name__} entries={entries} bytes={self.total_bytes} "
+            "hits={self.hits} misses={self.misses} evictions={self.evictions}>"
+        ).format(self=self, entries=len(self))
+
+    @property
+    def total_bytes(self) -> int:
+        """
+        The approximate total memory used by the cached sources.
+        """
+        return sum(self._sizes.values())
+
+    def get(self, key: Tuple[type, str, Sequence[str]]) -> Optional['Source']:
+        with self._lock:
+            source = self._sources.get(key)
+            if source is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._sources.move_to_end(key)
+            # The estimate grows as more data is lazily computed
+            self._sizes[key] = source._approximate_size()
+            self._evict_excess()
+            return source
+
+    def put(self, key: Tuple[type, str, Sequence[str]], source: 'Source') -> None:
+        with self._lock:
+            self._sources[key] = source
+            self._sizes[key] = source._approximate_size()
+            self._keys[id(source)] = key
+            self.evict_unloaded_modules()
+            self._evict_excess()
+
+    def note_module(self, source: 'Source', module_globals: Mapping[str, Any]) -> None:
+        """
+        Records that the given source belongs to the module with the given globals,
+        so that it can be evicted when that module is removed from sys.modules.
+        """
+        name = module_globals.get("__name__")
+        module = sys.modules.get(name) if isinstance(name, str) else None
+        if getattr(module, "__dict__", None) is not module_globals:
+            return
+        with self._lock:
+            key = self._keys.get(id(source))
+            if key is not None:
+                self._module_names[key] = name
+
+    def evict_unloaded_modules(self) -> None:
+        """
+        Evicts the sources of modules which are no longer in sys.modules.
+        This is also done automatically whenever a new source is added.
+        """
+        with self._lock:
+            for key, name in list(self._module_names.items()):
+                if name not in sys.modules:
+                    self._evict(key)
+
+    def clear(self) -> None:
+        """
+        Evicts everything.
+        """
+        with self._lock:
+            for key in list(self._sources):
+                self._evict(key)
+
+    def _evict_excess(self) -> None:
+        # Never evict the most recently used source, which is about to be used
+        while len(self._sources) > 1 and (
+                (self.max_entries is not None and len(self._sources) > self.max_entries)
+                or (self.max_bytes is not None and self.total_bytes > self.max_bytes)
+        ):
+            self._evict(next(iter(self._sources)))
+
+    def _evict(self, key: Tuple[type, str, Sequence[str]]) -> None:
+        source = self._sources.pop(key)
+        del self._sizes[key]
+        del self._keys[id(source)]
+        self._module_names.pop(key, None)
+        self.evictions += 1
+
+        # executing caches the Source of each code object it has seen,
+        # which would otherwise keep evicted sources alive
+        executing_cache = type(source).__dict__.get("__executing_cache", {})
+        for code_key, args in list(executing_cache.items()):
+            if args[0] is source:
+                executing_cache.pop(code_key, None)
+
+
+class TokenIndex(MappingABC):
+    """
+    A compact mapping from line numbers to lists of tokens starting in that line,
+    used for Source.tokens_by_lineno.
+    The tokens are Token objects from asttokens:
+    https://asttokens.readthedocs.io/en/latest/api-index.html#asttokens.util.Token
+
+    Rather than keeping a Token object for every token in the file,
+    the fields of the tokens are stored in parallel arrays
+    with a table of the index of the first token in each line.
+    Token objects are only created (and then cached) for lines that are actually looked up.
+
+    Looking up a line without any tokens returns an empty list.
+    """
+
+    _columns = ("type", "start_row", "start_col", "end_row", "end_col", "startpos", "endpos", "line_id")
+
+    def __init__(
+            self,
+            text: str,
+            columns: Mapping[str, array],
+            line_offsets: array,
+            lines: List[str],
+            strings: Mapping[int, str],
+    ):
+        self._text = text
+        self._columns_by_name = columns
+        # line_offsets[lineno] is the index of the first token starting at or after lineno
+        self._line_offsets = line_offsets
+        # The distinct .line attributes of the tokens, referred to by the line_id column
+        self._lines = lines
+        # Token strings which aren't simply the corresponding slice of the text
+        self._strings = strings
+        self._materialized = {}  # type: Dict[int, List[Token]]
+
+    @classmethod
+    def from_tokens(cls, text: str, tokens: Iterable[Token]) -> 'TokenIndex':
+        columns = {name: array("i") for name in cls._columns}
+        (types, start_rows, start_cols, end_rows, end_cols,
+         startposes, endposes, line_ids) = (columns[name] for name in cls._columns)
+        lines = []  # type: List[str]
+        strings = {}
+        for index, tok in enumerate(tokens):
+            types.append(tok.type)
+            start_rows.append(tok.start[0])
+            start_cols.append(tok.start[1])
+            end_rows.append(tok.end[0])
+            end_cols.append(tok.end[1])
+            startposes.append(tok.startpos)
+            endposes.append(tok.endpos)
+            if not lines or lines[-1] != tok.line:
+                lines.append(tok.line)
+            line_ids.append(len(lines) - 1)
+            if text[tok.startpos:tok.endpos] != tok.string:
+                strings[index] = tok.string
+
+        # Tokens are in order, so the tokens of each line are a contiguous range
+        line_offsets = array("i")
+        for index, row in enumerate(start_rows):
+            while len(line_offsets) <= row:
+                line_offsets.append(index)
+        line_offsets.append(len(start_rows))
+
+        return cls(text, columns, line_offsets, lines, strings)
+
+    def to_state(self) -> dict:
+        """
+        A dict of simple types (suitable for marshal) which can be passed to .from_state
+        """
+        return dict(
+            columns={name: column.tobytes() for name, column in self._columns_by_name.items()},
+            line_offsets=self._line_offsets.tobytes(),
+            lines=self._lines,
+            strings=self._strings,
+        )
+
+    @classmethod
+    def from_state(cls, text: str, state: dict) -> 'TokenIndex':
+        def from_bytes(b):
+            result = array("i")
+            result.frombytes(b)
+            return result
+
+        return cls(
+            text,
+            {name: from_bytes(column) for name, column in state["columns"].items()},
+            from_bytes(state["line_offsets"]),
+            state["lines"],
+            state["strings"],
+        )
+
+    @property
+    def num_tokens(self) -> int:
+        return len(self._columns_by_name["type"])
+
+    def _token_range(self, lineno: int) -> range:
+        offsets = self._line_offsets
+        if not (isinstance(lineno, int) and 0 <= lineno < len(offsets) - 1):
+            return range(0)
+        return range(offsets[lineno], offsets[lineno + 1])
+
+    def __getitem__(self, lineno: int) -> List[Token]:
+        try:
+            return self._materialized[lineno]
+        except KeyError:
+            pass
+
+        (types, start_rows, start_cols, end_rows, end_cols,
+         startposes, endposes, line_ids) = (self._columns_by_name[name] for name in self._columns)
+        result = []
+        for i in self._token_range(lineno):
+            startpos = startposes[i]
+            endpos = endposes[i]
+            string = self._strings.get(i)
+            if string is None:
+                string = self._text[startpos:endpos]
+            result.append(Token(
+                types[i],
+                string,
+                (start_rows[i], start_cols[i]),
+                (end_rows[i], end_cols[i]),
+                self._lines[line_ids[i]],
+                i,
+                startpos,
+                endpos,
+            ))
+        self._materialized[lineno] = result
+        return result
+
+    def __contains__(self, lineno) -> bool:
+        return bool(self._token_range(lineno))
+
+    def __iter__(self) -> Iterator[int]:
+        offsets = self._line_offsets
+        for lineno in range(len(offsets) - 1):
+            if offsets[lineno] < offsets[lineno + 1]:
+                yield lineno
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+
 class Source(executing.Source):
     """
     The source code of a single file and associated metadata.
@@ -86,11 +373,86 @@ class Source(executing.Source):
     In addition to the attributes from the base class executing.Source,
     if .tree is not None, meaning this is valid Python code, objects have:
         - pieces: a list of Piece objects
-        - tokens_by_lineno: a defaultdict(list) mapping line numbers to lists of tokens.
+        - tokens_by_lineno: a TokenIndex mapping line numbers to lists of tokens.
 
     Don't construct this class. Get an instance from frame_info.source.
+
+    Set Source.disk_cache to a DiskCache to load pieces and tokens from disk
+    instead of computing them in every new process.
+    Set Source.cache to a bounded SourceCache to limit how many Source objects
+    are kept in memory.
     """
 
+    disk_cache = None  # type: Optional[DiskCache]
+    cache = SourceCache()
+
+    # The number of pygmented blocks of code to keep per Source, see FrameInfo._pygmented_scope_lines
+    pygmented_cache_size = 16
+
+    # The number of frame layouts (included pieces and lines) to keep per Source,
+    # see FrameInfo._layout
+    layout_cache_size = 256
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._line_ranges = {}  # type: Dict[Tuple[str, int, int], Tuple[int, int]]
+
+    @classmethod
+    def for_filename(cls, filename, module_globals=None, use_cache=True) -> 'Source':
+        source = super().for_filename(filename, module_globals, use_cache)
+        if module_globals:
+            cls.cache.note_module(source, module_globals)
+        return source
+
+    @classmethod
+    def _for_filename_and_lines(cls, filename: str, lines: Sequence[str]) -> 'Source':
+        key = (cls, filename, lines)
+        source = cls.cache.get(key)
+        if source is None:
+            source = cls(filename, lines)
+            cls.cache.put(key, source)
+        return source
+
+    def _approximate_size(self) -> int:
+        """
+        A rough estimate of the memory used by this object in bytes, for SourceCache.max_bytes.
+        """
+        d = self.__dict__
+        size = len(self.text) * 3 + len(self.lines) * 60 + self._num_nodes * 200
+        if self._asttokens is not None:
+            size += len(self._asttokens.tokens) * 250
+        if "tokens_by_lineno" in d:
+            size += d["tokens_by_lineno"].num_tokens * 40
+        size += len(d.get("pieces", ())) * 60
+        size += len(self._line_ranges) * 150
+        if "_layout_cache" in d:
+            size += sum(
+                len(layout.lines) * 40
+                for layout in d["_layout_cache"].values()
+            )
+        if "_pygmented_cache" in d:
+            size += sum(
+                sum(map(len, lines)) * 2
+                for lines in d["_pygmented_cache"].values()
+            )
+        return size
+
+    @cached_property
+    def _line_numbers(self) -> LineNumbers:
+        return LineNumbers(self.text)
+
+    @cached_property
+    def _pygmented_cache(self) -> LRUCache:
+        return LRUCache(self.pygmented_cache_size)
+
+    @cached_property
+    def _layout_cache(self) -> LRUCache:
+        return LRUCache(self.layout_cache_size)
+
+    @cached_property
+    def _num_nodes(self) -> int:
+        return sum(map(len, self._nodes_by_line.values()))
+
     @cached_property
     def pieces(self) -> List[range]:
         if not self.tree:
@@ -98,19 +460,87 @@ class Source(executing.Source):
                 range(i, i + 1)
                 for i in range(1, len(self.lines) + 1)
             ]
+        entry = self._disk_cache_entry
+        if entry:
+            return entry.pieces
         return list(self._clean_pieces())
 
     @cached_property
     def tokens_by_lineno(self) -> Mapping[int, List[Token]]:
         if not self.tree:
             raise AttributeError("This file doesn't contain valid Python, so .tokens_by_lineno doesn't exist")
-        return group_by_key_func(
-            self.asttokens().tokens,
-            lambda tok: tok.start[0],
-        )
+        entry = self._disk_cache_entry
+        if entry:
+            return entry.tokens_by_lineno
+        return self._compute_tokens_by_lineno()
+
+    def _compute_tokens_by_lineno(self) -> TokenIndex:
+        if self._asttokens is not None:
+            tokens = self._asttokens.tokens
+        else:
+            # Tokenize without keeping an ASTTokens object with a Token for every token around
+            tokens = ASTTokens(self.text, filename=self.filename).tokens
+        return TokenIndex.from_tokens(self.text, tokens)
 
-    def _clean_pieces(self) -> Iterator[range]:
-        pieces = self._raw_split_into_pieces(self.tree, 1, len(self.lines) + 1)
+    @cached_property
+    def _disk_cache_entry(self) -> Optional[CacheEntry]:
+        if self.disk_cache is None:
+            return None
+        return self.disk_cache.get(self)
+
+    @cached_property
+    def _piece_starts(self) -> List[int]:
+        return [piece.start for piece in self.pieces]
+
+    @cached_property
+    def _piece_stops(self) -> List[int]:
+        return [piece.stop for piece in self.pieces]
+
+    @cached_property
+    def _scope_pieces_cache(self) -> Dict[ast.AST, Tuple[List[range], List[int]]]:
+        return {}
+
+    def _scope_pieces_index(self, scope: Optional[ast.AST]) -> Tuple[List[range], List[int]]:
+        """
+        Returns a pair of lists:
+            - the pieces contained in the given scope node (or all pieces if scope is None)
+            - the start line numbers of those pieces, for bisecting.
+        Pieces are sorted and don't overlap, so the pieces in a scope are a contiguous slice
+        of .pieces which can be found by bisecting instead of scanning every piece in the file.
+        The result is cached so that it's shared by all frames in the same scope.
+
+        If .pieces hasn't been computed for the whole file, only the given scope
+        is split into pieces, which gives the same result for that scope
+        but is much cheaper for a small function in a huge file.
+        """
+        if scope is None or isinstance(scope, ast.Module):
+            return self.pieces, self._piece_starts
+
+        try:
+            return self._scope_pieces_cache[scope]
+        except KeyError:
+            pass
+
+        if "pieces" in self.__dict__ or self.disk_cache is not None:
+            scope_start, scope_end = self.line_range(scope)
+            lo = bisect_left(self._piece_starts, scope_start)
+            hi = max(lo, bisect_right(self._piece_stops, scope_end))
+            pieces = self.pieces[lo:hi]
+        else:
+            pieces = list(self._clean_pieces(scope))
+
+        result = self._scope_pieces_cache[scope] = pieces, [piece.start for piece in pieces]
+        return result
+
+    def _clean_pieces(self, scope: Optional[ast.AST] = None) -> Iterator[range]:
+        """
+        Splits the whole file into pieces,
+        or just the given function or class node (including its header).
+        """
+        if scope is None:
+            pieces = self._raw_split_into_pieces(self.tree, 1, len(self.lines) + 1)
+        else:
+            pieces = self._raw_split_into_pieces(scope, *self.line_range(scope))
         pieces = [
             (start, end)
             for (start, end) in pieces
@@ -175,7 +605,16 @@ class Source(executing.Source):
         yield start, end
 
     def line_range(self, node: ast.AST) -> Tuple[int, int]:
-        return line_range(self.asttext(), node)
+        if not isinstance(node, (ast.stmt, ast.ExceptHandler)):
+            return line_range(self.asttext(), node)
+
+        # Statement ranges are remembered so that they can be saved in the disk cache
+        key = (type(node).__name__, node.lineno, node.col_offset)
+        try:
+            return self._line_ranges[key]
+        except KeyError:
+            result = self._line_ranges[key] = line_range(self.asttext(), node)
+            return result
 
 
 class Options:
@@ -190,6 +629,10 @@ class Options:
 
     If a piece (other than the executing piece) has more than max_lines_per_piece lines,
     it will be truncated with a gap in the middle. 
+
+    variables determines which expressions FrameInfo.variables evaluates,
+    see VariableSelection. If max_variables isn't None, at most that many
+    Variables are returned.
     """
     def __init__(
             self, *,
@@ -198,7 +641,9 @@ class Options:
             include_signature: bool = False,
             max_lines_per_piece: int = 6,
             pygments_formatter=None,
-            blank_lines = BlankLines.HIDDEN
+            blank_lines = BlankLines.HIDDEN,
+            variables: VariableSelection = VariableSelection.SCOPE,
+            max_variables: Optional[int] = None
     ):
         self.before = before
         self.after = after
@@ -206,12 +651,64 @@ class Options:
         self.max_lines_per_piece = max_lines_per_piece
         self.pygments_formatter = pygments_formatter
         self.blank_lines = blank_lines
+        self.variables = variables
+        self.max_variables = max_variables
 
     def __repr__(self):
-        keys = sorted(self.__dict__)
-        items = ("{}={!r}".format(k, self.__dict__[k]) for k in keys)
+        values = self._values()
+        items = ("{}={!r}".format(k, values[k]) for k in sorted(values))
         return "{}({})".format(type(self).__name__, ", ".join(items))
 
+    def _values(self) -> Dict[str, Any]:
+        return {k: v for k, v in self.__dict__.items() if not k.startswith("_")}
+
+    def _layout_key(self) -> tuple:
+        # The options which determine FrameInfo.included_pieces and FrameInfo.lines
+        return self.before, self.after, self.include_signature, self.max_lines_per_piece, self.blank_lines
+
+    def replace(self, **changes) -> 'Options':
+        """
+        Returns a copy of these options with the given values changed.
+        """
+        return type(self)(**dict(self._values(), **changes))
+
+    def freeze(self) -> 'FrozenOptions':
+        """
+        Returns an immutable and hashable copy of these options.
+        """
+        return FrozenOptions(**self._values())
+
+
+class FrozenOptions(Options):
+    """
+    An immutable and hashable version of Options, usually created by Options.freeze().
+    Use .replace() to get a copy with some values changed.
+    """
+    def __init__(self, **kwargs):
+        object.__setattr__(self, "_frozen", False)
+        super().__init__(**kwargs)
+        object.__setattr__(self, "_frozen", True)
+
+    def __setattr__(self, name, value):
+        if self._frozen:
+            raise AttributeError("FrozenOptions can't be modified, use .replace() instead")
+        object.__setattr__(self, name, value)
+
+    def __delattr__(self, name):
+        raise AttributeError("FrozenOptions can't be modified")
+
+    def _key(self) -> tuple:
+        return tuple(sorted(self._values().items()))
+
+    def __eq__(self, other):
+        return type(other) is type(self) and other._key() == self._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def freeze(self) -> 'FrozenOptions':
+        return self
+
 
 class LineGap(object):
     """
@@ -389,6 +886,10 @@ class Line(object):
         if pygmented and self.frame_info.scope:
             assert_(not markers, ValueError("Cannot use pygmented with markers"))
             start_line, lines = self.frame_info._pygmented_scope_lines
+            if not start_line <= self.lineno < start_line + len(lines):
+                # A Line constructed directly for a line that isn't displayed,
+                # so highlight the whole scope
+                start_line, lines = self.frame_info._pygmented_lines(1, len(self.frame_info.source.lines))
             result = lines[self.lineno - start_line]
             if strip_leading_indent:
                 result = result.replace(self.text[:self.leading_indent], "", 1)
@@ -447,7 +948,21 @@ def markers_from_ranges(
     return markers
 
 
+_executing_node_styles = {}  # type: Dict[Tuple[Any, str], type]
+
+
 def style_with_executing_node(style, modifier):
+    """
+    Returns a pygments style class based on the given style (a class or the name of one)
+    which also styles the executing node with the given modifier.
+    The result is cached, so constructing many formatters with the same arguments is cheap.
+    """
+    key = (style, modifier)
+    try:
+        return _executing_node_styles[key]
+    except KeyError:
+        pass
+
     from pygments.styles import get_style_by_name
     if isinstance(style, str):
         style = get_style_by_name(style)
@@ -463,9 +978,35 @@ def style_with_executing_node(style, modifier):
             }
         }
 
+    _executing_node_styles[key] = NewStyle
     return NewStyle
 
 
+def _frame_names(frame: Union[FrameType, FrameSnapshot]) -> Mapping[str, Any]:
+    """
+    The names available in a frame for pure_eval.
+    Unlike Evaluator.from_frame, this doesn't copy the namespaces,
+    since usually only a few names are looked up.
+    """
+    return ChainMap(*[
+        namespace if isinstance(namespace, MappingABC) else {}
+        for namespace in [frame.f_locals, frame.f_globals, frame.f_builtins]
+    ])
+
+
+def code_qualname(code: CodeType, module_globals: Optional[dict] = None) -> str:
+    """
+    The __qualname__ of the function or class whose code is given, or just the code name.
+    On Python 3.11+ this is code.co_qualname, otherwise it's found by parsing the source file.
+    Pass the globals of a frame running the code if possible,
+    so that the source can also be found by the module's loader.
+    """
+    try:
+        return code.co_qualname
+    except AttributeError:
+        return Source.for_filename(code.co_filename, module_globals).code_qualname(code)
+
+
 class RepeatedFrames:
     """
     A sequence of consecutive stack frames which shouldn't be displayed because
@@ -481,7 +1022,7 @@ class RepeatedFrames:
     """
     def __init__(
             self,
-            frames: List[Union[FrameType, TracebackType]],
+            frames: List[Union[FrameType, TracebackType, FrameSnapshot]],
             frame_keys: List[Tuple[CodeType, int]],
     ):
         self.frames = frames
@@ -495,9 +1036,13 @@ class RepeatedFrames:
         """
         counts = sorted(Counter(self.frame_keys).items(),
                         key=lambda item: (-item[1], item[0][0].co_name))
+        module_globals = {
+            frame.f_code: frame.f_globals
+            for frame, _ in map(frame_and_lineno, self.frames)
+        }
         return ', '.join(
             '{name} at line {lineno} ({count} times)'.format(
-                name=Source.for_filename(code.co_filename).code_qualname(code),
+                name=code_qualname(code, module_globals.get(code)),
                 lineno=lineno,
                 count=count,
             )
@@ -508,24 +1053,146 @@ class RepeatedFrames:
         return '<{self.__class__.__name__} {self.description}>'.format(self=self)
 
 
+class ElidedFrames:
+    """
+    A sequence of consecutive stack frames which were left out because of the
+    keep_first_frames and keep_last_frames arguments of FrameInfo.stack_data.
+    Nothing is done with these frames, so they cost nothing to skip.
+
+    Attributes:
+        - frames: list of raw frame or traceback objects
+        - description: A string briefly describing the frames
+    """
+    def __init__(self, frames: List[Union[FrameType, TracebackType, FrameSnapshot]]):
+        self.frames = frames
+
+    @property
+    def description(self) -> str:
+        """
+        A string briefly describing the elided frames, e.g.
+            100 frames
+        """
+        count = len(self.frames)
+        return '{} frame{}'.format(count, '' if count == 1 else 's')
+
+    def __repr__(self):
+        return '<{self.__class__.__name__} {self.description}>'.format(self=self)
+
+
+class HiddenFrames(ElidedFrames):
+    """
+    A sequence of consecutive stack frames which were left out because the frame_filter
+    passed to FrameInfo.stack_data returned False for them.
+    Nothing else is done with these frames, so they cost almost nothing to skip.
+
+    Attributes:
+        - frames: list of raw frame or traceback objects
+        - description: A string briefly describing the frames
+    """
+
+
+_FrameLayout = NamedTuple('_FrameLayout',
+                           [('included_pieces', List[range]),
+                            ('lines', List[Union[int, LineGap, Tuple[int, int]]]),
+                            ('leading_indent', Optional[int])])
+
+
+def _hide_frames(stack, frame_filter):
+    hidden = []
+    for frame_or_tb in stack:
+        if frame_filter(frame_or_tb):
+            if hidden:
+                yield HiddenFrames(hidden)
+                hidden = []
+            yield frame_or_tb
+        else:
+            hidden.append(frame_or_tb)
+    if hidden:
+        yield HiddenFrames(hidden)
+
+
+class _FramePosition:
+    """
+    Stands in for a live frame when finding its executing node,
+    with the line number and instruction the frame was at when this was created.
+    """
+    __slots__ = ("frame", "f_lineno", "f_lasti")
+
+    def __init__(self, frame: FrameType):
+        self.frame = frame
+        self.f_lineno = frame.f_lineno
+        self.f_lasti = frame.f_lasti
+
+    def __getattr__(self, name):
+        return getattr(self.frame, name)
+
+
+# Absolute paths found for relative code filenames, including names that couldn't be found.
+# Checking each directory in sys.path can be slow, e.g. on network filesystems.
+# The current directory and sys.path are part of the key, so changing them gives a fresh lookup.
+_resolved_filenames = LRUCache(1000)
+
+
+def _resolve_filename(filename: str) -> str:
+    if (
+            os.path.isabs(filename) or
+            (
+                    filename.startswith("<") and
+                    filename.endswith(">")
+            )
+    ):
+        return filename
+
+    try:
+        cwd = os.getcwd()
+    except OSError:
+        cwd = None
+    key = (filename, cwd, tuple(sys.path))
+    result = _resolved_filenames.get(key)
+    if result is None:
+        result = _resolved_filenames[key] = _search_filename(filename)
+    return result
+
+
+def _search_filename(filename: str) -> str:
+    # Try to make the filename absolute by trying all
+    # sys.path entries (which is also what linecache does)
+    # as well as the current working directory
+    for dirname in ["."] + list(sys.path):
+        try:
+            fullname = os.path.join(dirname, filename)
+            if os.path.isfile(fullname):
+                return os.path.abspath(fullname)
+        except Exception:
+            # Just in case that sys.path contains very
+            # strange entries...
+            pass
+
+    return filename
+
+
 class FrameInfo(object):
     """
     Information about a frame!
-    Pass either a frame object or a traceback object,
+    Pass either a frame object or a traceback object (or a FrameSnapshot of either),
     and optionally an Options object to configure.
 
     Or use the classmethod FrameInfo.stack_data() for an iterator of FrameInfo and
     RepeatedFrames objects. 
 
     Attributes:
-        - frame: an actual stack frame object, either frame_or_tb or frame_or_tb.tb_frame
+        - frame: an actual stack frame object, either frame_or_tb or frame_or_tb.tb_frame,
+            or a FrameSnapshot
         - options
         - code: frame.f_code
-        - source: a Source object
+        - code_qualname: the __qualname__ of the function or class being executed,
+            or just the code name. On Python 3.11+ this doesn't require reading the source.
+        - source: a Source object, only read when it's first needed
         - filename: a hopefully absolute file path derived from code.co_filename
         - scope: the AST node of the innermost function, class or module being executed
         - lines: a list of Line/LineGap objects to display, determined by options
-        - executing: an Executing object from the `executing` library, which has:
+        - executing: an Executing object from the `executing` library,
+            only computed when it's first needed, which has:
             - .node: the AST node being executed in this frame, or None if it's unknown
             - .statements: a set of one or more candidate statements (AST nodes, probably just one)
                 currently being executed in this frame.
@@ -545,16 +1212,35 @@ class FrameInfo(object):
     """
     def __init__(
             self,
-            frame_or_tb: Union[FrameType, TracebackType],
+            frame_or_tb: Union[FrameType, TracebackType, FrameSnapshot],
             options: Optional[Options] = None,
     ):
-        self.executing = Source.executing(frame_or_tb)
         frame, self.lineno = frame_and_lineno(frame_or_tb)
         self.frame = frame
         self.code = frame.f_code
         self.options = options or Options()  # type: Options
-        self.source = self.executing.source  # type: Source
 
+        # The source file is only read and parsed when something needs it,
+        # so e.g. a frame header can be formatted without touching the file.
+        # A live frame keeps running, so remember where it is now.
+        if isinstance(frame_or_tb, FrameType):
+            self._frame_or_tb = _FramePosition(frame_or_tb)
+        else:
+            self._frame_or_tb = frame_or_tb
+
+    @cached_property
+    def executing(self) -> executing.Executing:
+        result = Source.executing(self._frame_or_tb)
+        result.frame = self.frame
+        return result
+
+    @cached_property
+    def source(self) -> 'Source':
+        return self.executing.source
+
+    @cached_property
+    def code_qualname(self) -> str:
+        return code_qualname(self.code, self.frame.f_globals)
 
     def __repr__(self):
         return "{self.__class__.__name__}({self.frame})".format(self=self)
@@ -562,11 +1248,15 @@ class FrameInfo(object):
     @classmethod
     def stack_data(
             cls,
-            frame_or_tb: Union[FrameType, TracebackType],
+            frame_or_tb: Union[FrameType, TracebackType, FrameSnapshot],
             options: Optional[Options] = None,
             *,
-            collapse_repeated_frames: bool = True
-    ) -> Iterator[Union['FrameInfo', RepeatedFrames]]:
+            collapse_repeated_frames: bool = True,
+            keep_first_frames: Optional[int] = None,
+            keep_last_frames: Optional[int] = None,
+            collapse_window: Optional[int] = None,
+            frame_filter: Optional[Callable[[Union[FrameType, TracebackType, FrameSnapshot]], bool]] = None,
+    ) -> Iterator[Union['FrameInfo', RepeatedFrames, ElidedFrames]]:
         """
         An iterator of FrameInfo and RepeatedFrames objects representing
         a full traceback or stack. Similar consecutive frames are collapsed into RepeatedFrames
@@ -574,16 +1264,65 @@ class FrameInfo(object):
 
         Pass either a frame object or a traceback object,
         and optionally an Options object to configure.
+
+        If keep_first_frames or keep_last_frames is not None, only that many frames
+        at the start (outermost) and end (most recent) of the stack are included,
+        and the frames in between are replaced by a single ElidedFrames object.
+        This is decided before creating any FrameInfo objects,
+        so the elided frames don't cost any source reading or analysis.
+
+        Normally the whole stack is examined to find repeated frames before anything is yielded.
+        If collapse_window is not None, repeated frames are detected looking only
+        that many frames ahead, so for a traceback the first FrameInfo is yielded
+        without walking the rest of it. This may collapse slightly fewer frames,
+        see utils.collapse_repeated_streaming.
+
+        If frame_filter is not None, it's called with each raw frame or traceback object
+        (after applying keep_first_frames and keep_last_frames),
+        and frames for which it returns False are left out.
+        Consecutive frames that are left out are replaced by a single HiddenFrames object.
+        See stack_data.FrameFilter for a fast filter based on filenames and module names.
         """
-        stack = list(iter_stack(frame_or_tb))
+        limited = keep_first_frames is not None or keep_last_frames is not None
+        stack = iter_stack(frame_or_tb)
 
         # Reverse the stack from a frame so that it's in the same order
         # as the order from a traceback, which is the order of a printed
         # traceback when read top to bottom (most recent call last)
         if is_frame(frame_or_tb):
-            stack = stack[::-1]
+            stack = list(stack)[::-1]
+        elif collapse_window is None or limited:
+            stack = list(stack)
+
+        def part(frames):
+            return cls._stack_data_part(frames, options, collapse_repeated_frames, collapse_window, frame_filter)
+
+        if not limited:
+            yield from part(stack)
+            return
+
+        start = keep_first_frames or 0
+        end = max(start, len(stack) - (keep_last_frames or 0))
+        yield from part(stack[:start])
+        if end > start:
+            yield ElidedFrames(stack[start:end])
+        yield from part(stack[end:])
+
+    @classmethod
+    def _stack_data_part(
+            cls,
+            stack: Iterable[Union[FrameType, TracebackType, FrameSnapshot]],
+            options: Optional[Options],
+            collapse_repeated_frames: bool,
+            collapse_window: Optional[int],
+            frame_filter: Optional[Callable[[Union[FrameType, TracebackType, FrameSnapshot]], bool]],
+    ) -> Iterator[Union['FrameInfo', RepeatedFrames, HiddenFrames]]:
+        if frame_filter is not None:
+            stack = _hide_frames(stack, frame_filter)
 
         def mapper(f):
+            if isinstance(f, HiddenFrames):
+                return f
             return cls(f, options)
 
         if not collapse_repeated_frames:
@@ -591,9 +1330,22 @@ class FrameInfo(object):
             return
 
         def _frame_key(x):
+            if isinstance(x, HiddenFrames):
+                # Unique, so it's never collapsed
+                return x
             frame, lineno = frame_and_lineno(x)
             return frame.f_code, lineno
 
+        if collapse_window is not None:
+            yield from collapse_repeated_streaming(
+                stack,
+                mapper=mapper,
+                collapser=RepeatedFrames,
+                key=_frame_key,
+                window=collapse_window,
+            )
+            return
+
         yield from collapse_repeated(
             stack,
             mapper=mapper,
@@ -608,15 +1360,7 @@ class FrameInfo(object):
         unless there is no .scope (because the source isn't valid Python syntax)
         in which case it returns all the pieces in the source file, each containing one line.
         """
-        if not self.scope:
-            return self.source.pieces
-
-        scope_start, scope_end = self.source.line_range(self.scope)
-        return [
-            piece
-            for piece in self.source.pieces
-            if scope_start <= piece.start and piece.stop <= scope_end
-        ]
+        return self.source._scope_pieces_index(self.scope)[0]
 
     @cached_property
     def filename(self) -> str:
@@ -624,32 +1368,9 @@ class FrameInfo(object):
         A hopefully absolute file path derived from .code.co_filename,
         the current working directory, and sys.path.
         Code based on ipython.
+        Results are shared by all frames until the working directory or sys.path changes.
         """
-        result = self.code.co_filename
-
-        if (
-                os.path.isabs(result) or
-                (
-                        result.startswith("<") and
-                        result.endswith(">")
-                )
-        ):
-            return result
-
-        # Try to make the filename absolute by trying all
-        # sys.path entries (which is also what linecache does)
-        # as well as the current working directory
-        for dirname in ["."] + list(sys.path):
-            try:
-                fullname = os.path.join(dirname, result)
-                if os.path.isfile(fullname):
-                    return os.path.abspath(fullname)
-            except Exception:
-                # Just in case that sys.path contains very
-                # strange entries...
-                pass
-
-        return result
+        return _resolve_filename(self.code.co_filename)
 
     @cached_property
     def executing_piece(self) -> range:
@@ -657,10 +1378,20 @@ class FrameInfo(object):
         The piece (range of lines) containing the line currently being executed
         by the interpreter in this frame.
         """
+        return self.scope_pieces[self._executing_piece_index]
+
+    @cached_property
+    def _executing_piece_index(self) -> int:
+        """
+        The position of .executing_piece within .scope_pieces.
+        """
+        pieces, starts = self.source._scope_pieces_index(self.scope)
+        # The only piece that can contain lineno is the last one starting at or before it
+        i = bisect_right(starts, self.lineno) - 1
         return only(
-            piece
-            for piece in self.scope_pieces
-            if self.lineno in piece
+            j
+            for j in range(max(i, 0), i + 1)
+            if self.lineno in pieces[j]
         )
 
     @cached_property
@@ -674,11 +1405,14 @@ class FrameInfo(object):
         be a contiguous range of pieces).
         Always a subset of .scope_pieces.
         """
+        return list(self._layout.included_pieces)
+
+    def _select_included_pieces(self) -> List[range]:
         scope_pieces = self.scope_pieces
         if not self.scope_pieces:
             return []
 
-        pos = scope_pieces.index(self.executing_piece)
+        pos = self._executing_piece_index
         pieces_start = max(0, pos - self.options.before)
         pieces_end = pos + 1 + self.options.after
         pieces = scope_pieces[pieces_start:pieces_end]
@@ -693,6 +1427,20 @@ class FrameInfo(object):
 
         return pieces
 
+    @cached_property
+    def _layout(self) -> '_FrameLayout':
+        """
+        The included pieces and lines of this frame, which only depend on
+        the code, the line number and some of the options, so they're cached
+        in the source and shared by frames at the same position.
+        """
+        key = (self.code, self.lineno, self.options._layout_key())
+        cache = self.source._layout_cache
+        layout = cache.get(key)
+        if layout is None:
+            layout = cache[key] = self._compute_layout()
+        return layout
+
     @cached_property
     def _executing_node_common_indent(self) -> int:
         """
@@ -731,13 +1479,28 @@ class FrameInfo(object):
 
         The Line objects are all within the ranges from .included_pieces.
         """
-        pieces = self.included_pieces
+        layout = self._layout
+        result = []  # type: List[Union[Line, LineGap, BlankLineRange]]
+        for item in layout.lines:
+            if isinstance(item, int):
+                line = Line(self, item)
+                line.leading_indent = layout.leading_indent
+                result.append(line)
+            elif item is LINE_GAP:
+                result.append(LINE_GAP)
+            else:
+                result.append(BlankLineRange(*item))
+        return result
+
+    def _compute_layout(self) -> '_FrameLayout':
+        pieces = self._select_included_pieces()
         if not pieces:
-            return []
+            return _FrameLayout(pieces, [], None)
 
         add_empty_lines = self.options.blank_lines in (BlankLines.VISIBLE, BlankLines.SINGLE)
         prev_piece = None
-        result = []
+        # Line numbers for lines, LINE_GAP, and pairs of line numbers for BlankLineRanges
+        result = []  # type: List[Union[int, LineGap, Tuple[int, int]]]
         for i, piece in enumerate(pieces):
             if (
                     i == 1
@@ -748,36 +1511,30 @@ class FrameInfo(object):
                 result.append(LINE_GAP)
             elif prev_piece and add_empty_lines and piece.start > prev_piece.stop:
                 if self.options.blank_lines == BlankLines.SINGLE:
-                    result.append(BlankLineRange(prev_piece.stop, piece.start-1))
+                    result.append((prev_piece.stop, piece.start - 1))
                 else:  # BlankLines.VISIBLE
-                    for lineno in range(prev_piece.stop, piece.start):
-                        result.append(Line(self, lineno))
+                    result.extend(range(prev_piece.stop, piece.start))
 
-            lines = [Line(self, i) for i in piece]  # type: List[Line]
+            linenos = list(piece)  # type: List[Union[int, LineGap]]
             if piece != self.executing_piece:
-                lines = truncate(
-                    lines,
+                linenos = truncate(
+                    linenos,
                     max_length=self.options.max_lines_per_piece,
                     middle=[LINE_GAP],
                 )
-            result.extend(lines)
+            result.extend(linenos)
             prev_piece = piece
 
         real_lines = [
-            line
-            for line in result
-            if isinstance(line, Line)
+            self.source.lines[item - 1]
+            for item in result
+            if isinstance(item, int)
         ]
 
-        text = "\n".join(
-            line.text
-            for line in real_lines
-        )
+        text = "\n".join(real_lines)
         dedented_lines = dedent(text).splitlines()
-        leading_indent = len(real_lines[0].text) - len(dedented_lines[0])
-        for line in real_lines:
-            line.leading_indent = leading_indent
-        return result
+        leading_indent = len(real_lines[0]) - len(dedented_lines[0])
+        return _FrameLayout(pieces, result, leading_indent)
 
     @cached_property
     def scope(self) -> Optional[ast.AST]:
@@ -798,6 +1555,15 @@ class FrameInfo(object):
 
     @cached_property
     def _pygmented_scope_lines(self) -> Optional[Tuple[int, List[str]]]:
+        # Only highlight the lines that will be displayed rather than the whole scope.
+        pieces = self.included_pieces
+        return self._pygmented_lines(pieces[0].start, pieces[-1].stop - 1)
+
+    def _pygmented_lines(self, first_line: int, last_line: int) -> Tuple[int, List[str]]:
+        """
+        Returns the number of the first line of the highlighted code and the list of
+        highlighted lines covering first_line to last_line, within the scope.
+        """
         # noinspection PyUnresolvedReferences
         from pygments.formatters import HtmlFormatter
 
@@ -809,21 +1575,33 @@ class FrameInfo(object):
         if isinstance(formatter, HtmlFormatter):
             formatter.nowrap = True
 
+        # Pieces start at statement boundaries so the lexer starts in the right state,
+        # and the text is cut off at the start and end of the scope like it would be
+        # if the whole scope was highlighted, so the resulting lines are the same.
         atext = self.source.asttext()
+        line_numbers = self.source._line_numbers
+        scope_start, scope_end = atext.get_text_range(scope)
+        start = max(scope_start, line_numbers.line_to_offset(first_line, 0))
+        end = min(
+            scope_end,
+            line_numbers.line_to_offset(last_line, 0) + len(self.source.lines[last_line - 1]),
+        )
+        start_line = line_numbers.offset_to_line(start)[0]
+
         node = self.executing.node
         if node and getattr(formatter.style, "for_executing_node", False):
-            scope_start = atext.get_text_range(scope)[0]
-            start, end = atext.get_text_range(node)
-            start -= scope_start
-            end -= scope_start
-            ranges = [(start, end)]
+            node_start, node_end = atext.get_text_range(node)
+            ranges = [(node_start - start, node_end - start)]
         else:
             ranges = []
 
-        code = atext.get_text(scope)
-        lines = _pygmented_with_ranges(formatter, code, ranges)
-
-        start_line = self.source.line_range(scope)[0]
+        # Recursive calls and repeated exceptions highlight the same code in the same way,
+        # so the result is shared between frames
+        key = (start, end, formatter, formatter.style, tuple(ranges))
+        lines = self.source._pygmented_cache.get(key)
+        if lines is None:
+            code = self.source.text[start:end]
+            lines = self.source._pygmented_cache[key] = _pygmented_with_ranges(formatter, code, ranges)
 
         return start_line, lines
 
@@ -832,60 +1610,101 @@ class FrameInfo(object):
         """
         All Variable objects whose nodes are contained within .scope
         and whose values could be safely evaluated by pure_eval.
+
+        Options.variables can restrict this to the nodes in .lines or .executing_piece,
+        and Options.max_variables limits the number of Variables.
+        Only nodes that may end up in the result are evaluated.
         """
         if not self.scope:
             return []
 
-        evaluator = Evaluator.from_frame(self.frame)
-        scope = self.scope
-        node_values = [
-            pair
-            for pair in evaluator.find_expressions(scope)
-            if is_expression_interesting(*pair)
-        ]  # type: List[Tuple[ast.AST, Any]]
-
-        if isinstance(scope, (ast.FunctionDef, ast.AsyncFunctionDef)):
-            for node in ast.walk(scope.args):
-                if not isinstance(node, ast.arg):
-                    continue
-                name = node.arg
-                try:
-                    value = evaluator.names[name]
-                except KeyError:
-                    pass
-                else:
-                    node_values.append((node, value))
+        evaluator = Evaluator(_frame_names(self.frame))
 
-        # Group equivalent nodes together
         def get_text(n):
             if isinstance(n, ast.arg):
                 return n.arg
             else:
                 return self.source.asttext().get_text(n)
 
-        def normalise_node(n):
+        # A snapshot only has the reprs of local variables, other expressions can't be evaluated
+        names_only = isinstance(self.frame, FrameSnapshot)
+
+        def evaluate(n):
+            if isinstance(n, ast.arg):
+                try:
+                    return evaluator.names[n.arg]
+                except KeyError:
+                    raise CannotEval
+            if names_only and not isinstance(n, ast.Name):
+                raise CannotEval
+            value = evaluator[n]
+            if not is_expression_interesting(n, value):
+                raise CannotEval
+            return value
+
+        # Group equivalent nodes together.
+        # Nodes without source text (e.g. inside f-strings in some Python versions)
+        # are skipped.
+        max_variables = self.options.max_variables
+        memo = {}
+        grouped = {}  # type: Dict[Any, List[Tuple[ast.AST, Any]]]
+        for node in self._variable_nodes():
+            if not get_text(node):
+                continue
+            key = node_structure(node, memo)
+            if (
+                    key not in grouped
+                    and max_variables is not None
+                    and len(grouped) >= max_variables
+            ):
+                continue
+
             try:
-                # Add parens to avoid syntax errors for multiline expressions
-                return ast.parse('(' + get_text(n) + ')')
-            except Exception:
-                return n
-
-        grouped = group_by_key_func(
-            node_values,
-            lambda nv: ast.dump(normalise_node(nv[0])),
-        )
+                value = evaluate(node)
+            except CannotEval:
+                continue
+            grouped.setdefault(key, []).append((node, value))
 
         result = []
         for group in grouped.values():
             nodes, values = zip(*group)
-            value = values[0]
-            text = get_text(nodes[0])
-            if not text:
-                continue
-            result.append(Variable(text, nodes, value))
+            result.append(Variable(get_text(nodes[0]), nodes, values[0]))
 
         return result
 
+    def _variable_nodes(self) -> Iterator[ast.AST]:
+        """
+        The expression nodes in .scope followed by the function's arguments,
+        limited to the lines selected by Options.variables.
+        Subtrees of statements outside those lines aren't walked at all.
+        """
+        scope = self.scope
+        selection = self.options.variables
+        if selection == VariableSelection.LINES:
+            linenos = {line.lineno for line in self.lines if isinstance(line, Line)}
+        elif selection == VariableSelection.EXECUTING_PIECE:
+            linenos = set(self.executing_piece)
+        else:
+            linenos = None
+
+        def in_lines(n):
+            return linenos is None or not linenos.isdisjoint(range(*self.source.line_range(n)))
+
+        # Breadth first like ast.walk
+        todo = deque([scope])
+        while todo:
+            node = todo.popleft()
+            if node is not scope and isinstance(node, (ast.stmt, ast.ExceptHandler)) and not in_lines(node):
+                continue
+            todo.extend(ast.iter_child_nodes(node))
+            if isinstance(node, ast.expr) and in_lines(node):
+                yield node
+
+        if isinstance(scope, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            for node in ast.walk(scope.args):
+                if isinstance(node, ast.arg) and in_lines(node):
+                    yield node
+
     @cached_property
     def variables_by_lineno(self) -> Mapping[int, List[Tuple[Variable, ast.AST]]]:
         """
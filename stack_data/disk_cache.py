@@ -0,0 +1,170 @@
+import hashlib
+import marshal
+import os
+import sys
+import tempfile
+from typing import Optional, List, Mapping, Iterable, NamedTuple
+
+from asttokens.util import Token
+
+# Bump this whenever the layout of cache files or the way pieces are computed changes
+FORMAT_VERSION = 2
+
+CacheEntry = NamedTuple('CacheEntry',
+                        [('pieces', List[range]),
+                         ('tokens_by_lineno', Mapping[int, List[Token]])])
+CacheEntry.__doc__ = """
+The data of a Source that was loaded from or just written to a DiskCache.
+"""
+
+
+class DiskCache:
+    """
+    An opt-in persistent cache of the expensive parts of analysing a Source,
+    namely .pieces, .tokens_by_lineno and the line ranges of statements,
+    so that a fresh process can load them from disk instead of recomputing them.
+
+    Enable it with:
+
+        Source.disk_cache = DiskCache(directory)
+
+    Each source file gets one cache file in the directory.
+    An entry is only used if the size, modification time and content hash
+    of the source file all match what was recorded when it was written.
+    Entries are also versioned by the cache format and Python implementation,
+    since the AST (and therefore the pieces) can differ between Python versions.
+
+    The cache is best effort: any error reading or writing it is ignored
+    and the data is simply computed as usual.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = os.path.abspath(directory)
+
+    def __repr__(self):
+        return "{}({!r})".format(type(self).__name__, self.directory)
+
+    def path_for(self, filename: str) -> str:
+        """
+        The path of the cache file for the given source filename.
+        """
+        try:
+            from stack_data.version import __version__
+        except ImportError:  # pragma: no cover
+            __version__ = "dev"
+
+        digest = hashlib.sha1(os.path.abspath(filename).encode("utf8", "surrogatepass")).hexdigest()
+        return os.path.join(
+            self.directory,
+            "{}-{}-{}-{}.marshal".format(FORMAT_VERSION, __version__, sys.implementation.cache_tag, digest),
+        )
+
+    def get(self, source) -> Optional[CacheEntry]:
+        """
+        Returns the cached data for the given Source,
+        computing and writing it first if necessary.
+        Returns None if the source can't be cached,
+        e.g. because it isn't valid Python or isn't a real file.
+        """
+        key = _source_key(source)
+        if key is None:
+            return None
+
+        path = self.path_for(source.filename)
+        entry = self._load(source, path, key)
+        if entry is None:
+            entry = self._store(source, path, key)
+        return entry
+
+    def store(self, source) -> bool:
+        """
+        Computes the cached data for the given Source and writes it to disk
+        if there isn't already an up to date entry.
+        Returns True if the source has an entry afterwards.
+        """
+        return self.get(source) is not None
+
+    def warm(self, filenames: Iterable[str]) -> int:
+        """
+        Populates the cache for the given source files.
+        Returns the number of files that are now cached.
+        """
+        # Imported here to avoid a circular import
+        from stack_data.core import Source
+
+        count = 0
+        for filename in filenames:
+            try:
+                source = Source.for_filename(filename)
+            except Exception:
+                continue
+            if self.store(source):
+                count += 1
+        return count
+
+    def _load(self, source, path: str, key: tuple) -> Optional[CacheEntry]:
+        try:
+            with open(path, "rb") as f:
+                data = marshal.load(f)
+        except Exception:
+            return None
+
+        if not (isinstance(data, dict) and data.get("key") == key):
+            return None
+
+        # Imported here to avoid a circular import
+        from stack_data.core import TokenIndex
+
+        try:
+            pieces = [range(start, stop) for start, stop in data["pieces"]]
+            tokens_by_lineno = TokenIndex.from_state(source.text, data["tokens"])
+            source._line_ranges.update(data["line_ranges"])
+        except Exception:
+            return None
+
+        return CacheEntry(pieces, tokens_by_lineno)
+
+    def _store(self, source, path: str, key: tuple) -> Optional[CacheEntry]:
+        if not source.tree:
+            return None
+
+        pieces = list(source._clean_pieces())
+        tokens_by_lineno = source._compute_tokens_by_lineno()
+        data = dict(
+            key=key,
+            pieces=[(piece.start, piece.stop) for piece in pieces],
+            tokens=tokens_by_lineno.to_state(),
+            line_ranges=dict(source._line_ranges),
+        )
+
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    marshal.dump(data, f)
+                os.replace(temp_path, path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+        except Exception:
+            pass
+
+        return CacheEntry(pieces, tokens_by_lineno)
+
+
+def _source_key(source) -> Optional[tuple]:
+    """
+    The size, modification time and content hash identifying the current version
+    of the source file, or None if it doesn't correspond to a file on disk.
+    """
+    if not source.tree:
+        return None
+
+    try:
+        stat = os.stat(source.filename)
+    except (OSError, ValueError):
+        return None
+
+    digest = hashlib.sha1(source.text.encode("utf8", "surrogatepass")).hexdigest()
+    return os.path.abspath(source.filename), stat.st_size, stat.st_mtime_ns, digest
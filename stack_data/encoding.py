@@ -0,0 +1,157 @@
+"""
+A compact binary encoding for the output of Serializer, as an alternative to JSON
+when sending tracebacks over the wire:
+
+    data = encode(serializer.format_exception(e))
+    assert decode(data) == serializer.format_exception(e)
+
+Filenames, function names, source lines and dictionary keys are repeated many times
+in a serialized traceback, so every string is stored once in a table at the start
+of the payload and referred to by its index. Integers, lengths and indices are varints.
+
+Any JSON-like value can be encoded: dicts with string keys, lists (and tuples, which are
+decoded as lists), strings, ints, floats, booleans and None.
+"""
+
+import struct
+from typing import Any, Dict, List
+
+MAGIC = b"SD\x01"
+
+_NONE, _FALSE, _TRUE, _INT, _FLOAT, _STR, _LIST, _DICT = range(8)
+
+_float = struct.Struct("<d")
+
+
+def _write_varint(out: bytearray, n: int):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def encode(value: Any) -> bytes:
+    """
+    Returns the binary encoding of value. Raises TypeError for values that can't be encoded.
+    """
+    strings = {}  # type: Dict[str, int]
+    body = bytearray()
+
+    def write_string(s: str):
+        try:
+            index = strings[s]
+        except KeyError:
+            index = strings[s] = len(strings)
+        _write_varint(body, index)
+
+    def write(x):
+        if isinstance(x, str):
+            body.append(_STR)
+            write_string(x)
+        elif x is None:
+            body.append(_NONE)
+        elif x is True:
+            body.append(_TRUE)
+        elif x is False:
+            body.append(_FALSE)
+        elif isinstance(x, int):
+            body.append(_INT)
+            # Zigzag encoding so that small negative numbers are also short
+            _write_varint(body, x * 2 if x >= 0 else -x * 2 - 1)
+        elif isinstance(x, float):
+            body.append(_FLOAT)
+            body.extend(_float.pack(x))
+        elif isinstance(x, dict):
+            body.append(_DICT)
+            _write_varint(body, len(x))
+            for key, item in x.items():
+                if not isinstance(key, str):
+                    raise TypeError("Keys must be str, not {}".format(type(key).__name__))
+                write_string(key)
+                write(item)
+        elif isinstance(x, (list, tuple)):
+            body.append(_LIST)
+            _write_varint(body, len(x))
+            for item in x:
+                write(item)
+        else:
+            raise TypeError("Object of type {} can't be encoded".format(type(x).__name__))
+
+    write(value)
+
+    # The table is written after the value has been walked, once all the strings are known
+    result = bytearray(MAGIC)
+    _write_varint(result, len(strings))
+    for s in strings:
+        encoded = s.encode("utf8", "surrogatepass")
+        _write_varint(result, len(encoded))
+        result.extend(encoded)
+    result.extend(body)
+    return bytes(result)
+
+
+def decode(data: bytes) -> Any:
+    """
+    Returns the value that was passed to encode(). Raises ValueError if data is invalid.
+    """
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("Not data from stack_data.encoding.encode()")
+
+    pos = len(MAGIC)
+
+    def read_varint() -> int:
+        nonlocal pos
+        result = shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            result |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return result
+            shift += 7
+
+    def read():
+        nonlocal pos
+        tag = data[pos]
+        pos += 1
+        if tag == _STR:
+            return strings[read_varint()]
+        elif tag == _DICT:
+            result = {}
+            for _ in range(read_varint()):
+                key = strings[read_varint()]
+                result[key] = read()
+            return result
+        elif tag == _LIST:
+            return [read() for _ in range(read_varint())]
+        elif tag == _INT:
+            n = read_varint()
+            return -(n + 1) // 2 if n & 1 else n // 2
+        elif tag == _NONE:
+            return None
+        elif tag == _TRUE:
+            return True
+        elif tag == _FALSE:
+            return False
+        elif tag == _FLOAT:
+            pos += _float.size
+            return _float.unpack_from(data, pos - _float.size)[0]
+        else:
+            raise ValueError("Invalid tag {} at position {}".format(tag, pos - 1))
+
+    try:
+        strings = []  # type: List[str]
+        for _ in range(read_varint()):
+            length = read_varint()
+            strings.append(bytes(data[pos:pos + length]).decode("utf8", "surrogatepass"))
+            pos += length
+
+        result = read()
+    except (IndexError, struct.error):
+        raise ValueError("Truncated or invalid data")
+
+    if pos > len(data):
+        raise ValueError("Truncated or invalid data")
+    if pos < len(data):
+        raise ValueError("Unexpected data after position {}".format(pos))
+    return result
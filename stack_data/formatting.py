@@ -2,14 +2,29 @@ import inspect
 import sys
 import traceback
 from types import FrameType, TracebackType
-from typing import Union, Iterable
+from typing import Union, Iterable, List, Optional
 
-from stack_data import (style_with_executing_node, Options, Line, FrameInfo, LINE_GAP,
-                       Variable, RepeatedFrames, BlankLineRange, BlankLines)
-from stack_data.utils import assert_
+from stack_data import (style_with_executing_node, Options, FrozenOptions, Line, FrameInfo, LINE_GAP,
+                       Variable, RepeatedFrames, ElidedFrames, HiddenFrames, BlankLineRange, BlankLines)
+from stack_data.background import BackgroundWorker
+from stack_data.snapshot import ExceptionSnapshot, FrameSnapshot
+from stack_data.utils import assert_, overrides_any, ScopedCache
+from stack_data.value_repr import ValueRepr, ReprMemo
 
 
 class Formatter:
+    # Frames at the same position in the code, e.g. within format_exceptions,
+    # share the output of these methods, as long as none of them are overridden.
+    # Set share_frame_layouts = True in a subclass whose overrides of them
+    # only depend on the position, and not e.g. on local variables.
+    _frame_layout_methods = (
+        "_format_frame_layout",
+        "format_frame_header",
+        "format_line",
+        "format_blank_lines_linenumbers",
+    )
+    share_frame_layouts = None  # type: Optional[bool]
+
     def __init__(
             self, *,
             options=None,
@@ -30,7 +45,13 @@ class Formatter:
             strip_leading_indent=True,
             html=False,
             chain=True,
-            collapse_repeated_frames=True
+            collapse_repeated_frames=True,
+            value_repr=None,
+            background_worker=None,
+            keep_first_frames=None,
+            keep_last_frames=None,
+            collapse_window=None,
+            frame_filter=None,
     ):
         if options is None:
             options = Options()
@@ -45,10 +66,14 @@ class Formatter:
                 from pygments.formatters.terminal256 import Terminal256Formatter \
                     as pygments_formatter_cls
 
-            options.pygments_formatter = pygments_formatter_cls(
+            pygments_formatter = pygments_formatter_cls(
                 style=pygments_style,
                 **pygments_formatter_kwargs or {},
             )
+            if isinstance(options, FrozenOptions):
+                options = options.replace(pygments_formatter=pygments_formatter)
+            else:
+                options.pygments_formatter = pygments_formatter
 
         self.pygmented = pygmented
         self.show_executing_node = show_executing_node
@@ -69,19 +94,46 @@ class Formatter:
         self.chain = chain
         self.options = options
         self.collapse_repeated_frames = collapse_repeated_frames
+        self.keep_first_frames = keep_first_frames
+        self.keep_last_frames = keep_last_frames
+        self.collapse_window = collapse_window
+        self.frame_filter = frame_filter
+        self.value_repr = value_repr or ValueRepr()
+        self._repr_memo = ReprMemo()
+        self._frame_layouts = ScopedCache()
+        self.background_worker = background_worker or BackgroundWorker()
         if not self.show_linenos and self.options.blank_lines == BlankLines.SINGLE:
             raise ValueError(
                 "BlankLines.SINGLE option can only be used when show_linenos=True"
             )
 
-    def set_hook(self):
+    def set_hook(self, *, background=False):
         def excepthook(_etype, evalue, _tb):
-            self.print_exception(evalue)
+            self.print_exception(evalue, background=background)
 
         sys.excepthook = excepthook
 
-    def print_exception(self, e=None, *, file=None):
-        self.print_lines(self.format_exception(e), file=file)
+    def print_exception(self, e=None, *, file=None, background=False):
+        """
+        Prints the formatted exception, by default the one currently being handled.
+
+        If background is true, only a snapshot of the exception is taken
+        (see stack_data.snapshot) and it's formatted and printed
+        by self.background_worker in another thread.
+        """
+        if not background:
+            self.print_lines(self.format_exception(e), file=file)
+            return
+
+        if e is None:
+            e = sys.exc_info()[1]
+        if file is None:
+            file = sys.stderr
+
+        snapshot = ExceptionSnapshot(e, variables=self.show_variables, value_repr=self.value_repr)
+        self.background_worker.submit(
+            lambda: self.print_lines(self.format_exception(snapshot), file=file)
+        )
 
     def print_stack(self, frame_or_tb=None, *, file=None):
         if frame_or_tb is None:
@@ -99,6 +151,9 @@ class Formatter:
         if e is None:
             e = sys.exc_info()[1]
 
+        return self._iter_scopes(self._format_exception(e))
+
+    def _format_exception(self, e) -> Iterable[str]:
         if self.chain:
             if e.__cause__ is not None:
                 yield from self.format_exception(e.__cause__)
@@ -110,26 +165,59 @@ class Formatter:
 
         yield 'Traceback (most recent call last):\n'
         yield from self.format_stack(e.__traceback__)
-        yield from traceback.format_exception_only(type(e), e)
+        if isinstance(e, ExceptionSnapshot):
+            yield from e.exception_only
+        else:
+            yield from traceback.format_exception_only(type(e), e)
+
+    def _iter_scopes(self, lines: Iterable[str]) -> Iterable[str]:
+        # Objects and frame layouts are shared within one call of format_exception/format_stack.
+        # The scopes are only current while the lines are being computed,
+        # so a partly consumed generator doesn't affect later calls.
+        return self._repr_memo.iter_scope(self._frame_layouts.iter_scope(lines))
+
+    def format_exceptions(self, items) -> List[str]:
+        """
+        Formats many exceptions (or snapshots of exceptions) at once,
+        returning one string for each. Tracebacks and frames are formatted as stacks.
+        The source lines of frames at the same position are only formatted once,
+        so this is faster than formatting the items separately if they share many frames.
+        """
+        return list(self._frame_layouts.iter_scope(
+            "".join(
+                self.format_exception(item)
+                if isinstance(item, (BaseException, ExceptionSnapshot))
+                else self.format_stack(item)
+            )
+            for item in items
+        ))
 
     def format_stack(self, frame_or_tb=None) -> Iterable[str]:
         if frame_or_tb is None:
             frame_or_tb = inspect.currentframe().f_back
 
-        yield from self.format_stack_data(
+        return self._iter_scopes(self.format_stack_data(
             FrameInfo.stack_data(
                 frame_or_tb,
                 self.options,
                 collapse_repeated_frames=self.collapse_repeated_frames,
+                keep_first_frames=self.keep_first_frames,
+                keep_last_frames=self.keep_last_frames,
+                collapse_window=self.collapse_window,
+                frame_filter=self.frame_filter,
             )
-        )
+        ))
 
     def format_stack_data(
-            self, stack: Iterable[Union[FrameInfo, RepeatedFrames]]
+            self, stack: Iterable[Union[FrameInfo, RepeatedFrames, ElidedFrames]]
     ) -> Iterable[str]:
         for item in stack:
             if isinstance(item, FrameInfo):
                 yield from self.format_frame(item)
+            elif isinstance(item, HiddenFrames):
+                yield self.format_hidden_frames(item)
+            elif isinstance(item, ElidedFrames):
+                yield self.format_elided_frames(item)
             else:
                 yield self.format_repeated_frames(item)
 
@@ -138,10 +226,40 @@ class Formatter:
             repeated_frames.description
         )
 
-    def format_frame(self, frame: Union[FrameInfo, FrameType, TracebackType]) -> Iterable[str]:
+    def format_elided_frames(self, elided_frames: ElidedFrames) -> str:
+        return '    [... skipping {}]\n'.format(
+            elided_frames.description
+        )
+
+    def format_hidden_frames(self, hidden_frames: HiddenFrames) -> str:
+        return '    [... {} hidden]\n'.format(
+            hidden_frames.description
+        )
+
+    def format_frame(self, frame: Union[FrameInfo, FrameType, TracebackType, FrameSnapshot]) -> Iterable[str]:
         if not isinstance(frame, FrameInfo):
             frame = FrameInfo(frame, self.options)
 
+        if self._shares_frame_layouts():
+            yield from self._frame_layouts.get(
+                (frame.code, frame.lineno, frame.executing.node),
+                lambda: list(self._format_frame_layout(frame)),
+            )
+        else:
+            yield from self._format_frame_layout(frame)
+
+        if self.show_variables:
+            try:
+                yield from self.format_variables(frame)
+            except Exception:
+                pass
+
+    def _shares_frame_layouts(self) -> bool:
+        if self.share_frame_layouts is not None:
+            return self.share_frame_layouts
+        return not overrides_any(self, Formatter, self._frame_layout_methods)
+
+    def _format_frame_layout(self, frame: FrameInfo) -> Iterable[str]:
         yield self.format_frame_header(frame)
 
         for line in frame.lines:
@@ -153,17 +271,11 @@ class Formatter:
                 assert_(line is LINE_GAP)
                 yield self.line_gap_string + "\n"
 
-        if self.show_variables:
-            try:
-                yield from self.format_variables(frame)
-            except Exception:
-                pass
-
     def format_frame_header(self, frame_info: FrameInfo) -> str:
         return ' File "{frame_info.filename}", line {frame_info.lineno}, in {name}\n'.format(
             frame_info=frame_info,
             name=(
-                frame_info.executing.code_qualname()
+                frame_info.code_qualname
                 if self.use_code_qualname else
                 frame_info.code.co_name
             ),
@@ -231,4 +343,5 @@ class Formatter:
         )
 
     def format_variable_value(self, value) -> str:
-        return repr(value)
+        # Objects shared between frames are only rendered once per format_exception/format_stack
+        return self._repr_memo.repr(value, self.value_repr)
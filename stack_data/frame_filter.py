@@ -0,0 +1,112 @@
+import fnmatch
+import os
+import re
+import site
+import sysconfig
+from types import FrameType, TracebackType
+from typing import Dict, Iterable, Union
+
+from stack_data.snapshot import FrameSnapshot
+from stack_data.utils import frame_and_lineno
+
+
+class FrameFilter:
+    """
+    A fast frame_filter for FrameInfo.stack_data, Formatter and Serializer,
+    which hides frames based only on the filename and module name of their code,
+    so that hidden frames don't need their source files to be read.
+
+    - paths: directories, or glob patterns (containing *, ? or [) matched against the whole filename.
+        Frames from files in these directories or matching these patterns are hidden.
+    - modules: frames from these modules and their submodules are hidden.
+    - site_packages: hide frames from installed third party packages.
+    - stdlib: hide frames from the standard library.
+
+    Calling the filter returns False for frames that should be hidden. For example:
+
+        Formatter(frame_filter=FrameFilter(site_packages=True, modules=["myapp.middleware"]))
+    """
+
+    def __init__(
+            self,
+            *,
+            paths: Iterable[str] = (),
+            modules: Iterable[str] = (),
+            site_packages: bool = False,
+            stdlib: bool = False,
+    ):
+        prefixes = []
+        patterns = []
+        for path in paths:
+            if any(c in path for c in "*?["):
+                patterns.append(fnmatch.translate(path))
+            else:
+                prefixes.append(_directory_prefix(path))
+
+        site_prefixes = tuple(_directory_prefix(path) for path in _site_packages_paths())
+        if site_packages:
+            prefixes.extend(site_prefixes)
+
+        self._prefixes = tuple(prefixes)
+        self._pattern = re.compile("|".join(patterns)) if patterns else None
+        self._modules = tuple(modules)
+        self._module_prefixes = tuple(module + "." for module in self._modules)
+        self._stdlib_prefixes = tuple(
+            _directory_prefix(path) for path in _stdlib_paths()
+        ) if stdlib else ()
+        self._site_prefixes = site_prefixes
+
+        # Results for each filename, as there are only so many files
+        self._hidden_filenames = {}  # type: Dict[str, bool]
+
+    def __call__(self, frame_or_tb: Union[FrameType, TracebackType, FrameSnapshot]) -> bool:
+        frame, _ = frame_and_lineno(frame_or_tb)
+        filename = frame.f_code.co_filename
+        try:
+            hidden = self._hidden_filenames[filename]
+        except KeyError:
+            hidden = self._hidden_filenames[filename] = self._is_hidden_filename(filename)
+        if hidden:
+            return False
+
+        if self._modules:
+            module = frame.f_globals.get("__name__") or ""
+            if module in self._modules or module.startswith(self._module_prefixes):
+                return False
+
+        return True
+
+    def _is_hidden_filename(self, filename: str) -> bool:
+        if filename.startswith("<frozen "):
+            return bool(self._stdlib_prefixes)
+
+        path = os.path.abspath(filename) if not filename.startswith("<") else filename
+        if path.startswith(self._prefixes):
+            return True
+        if self._pattern and (self._pattern.match(filename) or self._pattern.match(path)):
+            return True
+        # site-packages is usually inside the standard library directory
+        return path.startswith(self._stdlib_prefixes) and not path.startswith(self._site_prefixes)
+
+
+def _directory_prefix(path: str) -> str:
+    return os.path.join(os.path.abspath(path), "")
+
+
+def _site_packages_paths():
+    paths = {sysconfig.get_paths()[name] for name in ["purelib", "platlib"]}
+    try:
+        paths.update(site.getsitepackages())
+    except AttributeError:  # pragma: no cover
+        # Not available in old virtualenvs
+        pass
+    user_site = getattr(site, "getusersitepackages", lambda: None)()
+    if user_site:
+        paths.add(user_site)
+    return sorted(paths)
+
+
+def _stdlib_paths():
+    paths = {sysconfig.get_paths()[name] for name in ["stdlib", "platstdlib"]}
+    paths.add(os.path.dirname(os.__file__))
+    return sorted(paths)
@@ -1,26 +1,39 @@
 import inspect
+import json
 import logging
 import sys
 import traceback
 from collections import Counter
 from html import escape as escape_html
 from types import FrameType, TracebackType
-from typing import Union, Iterable, List
+from typing import Union, Iterable, Iterator, List, Optional, TextIO
 
 from stack_data import (
     style_with_executing_node,
     Options,
+    FrozenOptions,
     Line,
     FrameInfo,
     Variable,
     RepeatedFrames,
+    ElidedFrames,
+    HiddenFrames,
 )
-from stack_data.utils import some_str
+from stack_data.snapshot import ExceptionSnapshot, FrameSnapshot
+from stack_data.utils import some_str, overrides_any, ScopedCache
+from stack_data.value_repr import ValueRepr, ReprMemo
 
 log = logging.getLogger(__name__)
 
 
 class Serializer:
+    # Frames at the same position in the code, e.g. within format_exceptions,
+    # share the output of these methods, as long as none of them are overridden.
+    # Set share_frame_layouts = True in a subclass whose overrides of them
+    # only depend on the position, and not e.g. on local variables.
+    _frame_layout_methods = ("_format_frame_layout", "format_lines", "format_line")
+    share_frame_layouts = None  # type: Optional[bool]
+
     def __init__(
         self,
         *,
@@ -37,6 +50,12 @@ class Serializer:
         chain=True,
         collapse_repeated_frames=True,
         show_variables=False,
+        value_repr=None,
+        reference_repeated_values=False,
+        keep_first_frames=None,
+        keep_last_frames=None,
+        collapse_window=None,
+        frame_filter=None,
     ):
         if options is None:
             options = Options()
@@ -57,10 +76,14 @@ class Serializer:
                         Terminal256Formatter as pygments_formatter_cls,
                     )
 
-            options.pygments_formatter = pygments_formatter_cls(
+            pygments_formatter = pygments_formatter_cls(
                 style=pygments_style,
                 **pygments_formatter_kwargs or {},
             )
+            if isinstance(options, FrozenOptions):
+                options = options.replace(pygments_formatter=pygments_formatter)
+            else:
+                options.pygments_formatter = pygments_formatter
 
         self.pygmented = pygmented
         self.use_code_qualname = use_code_qualname
@@ -69,7 +92,15 @@ class Serializer:
         self.chain = chain
         self.options = options
         self.collapse_repeated_frames = collapse_repeated_frames
+        self.keep_first_frames = keep_first_frames
+        self.keep_last_frames = keep_last_frames
+        self.collapse_window = collapse_window
+        self.frame_filter = frame_filter
         self.show_variables = show_variables
+        self.value_repr = value_repr or ValueRepr()
+        self.reference_repeated_values = reference_repeated_values
+        self._repr_memo = ReprMemo()
+        self._frame_layouts = ScopedCache()
 
     def format_exception(self, e=None) -> List[dict]:
         if e is None:
@@ -77,49 +108,154 @@ class Serializer:
 
         result = []
 
-        if self.chain:
-            if e.__cause__ is not None:
-                result = self.format_exception(e.__cause__)
-                result[-1]["tail"] = traceback._cause_message.strip()
-            elif e.__context__ is not None and not e.__suppress_context__:
-                result = self.format_exception(e.__context__)
-                result[-1]["tail"] = traceback._context_message.strip()
+        with self._repr_memo.scope(), self._frame_layouts.scope():
+            if self.chain:
+                if e.__cause__ is not None:
+                    result = self.format_exception(e.__cause__)
+                    result[-1]["tail"] = traceback._cause_message.strip()
+                elif e.__context__ is not None and not e.__suppress_context__:
+                    result = self.format_exception(e.__context__)
+                    result[-1]["tail"] = traceback._context_message.strip()
 
-        result.append(self.format_traceback_part(e))
+            result.append(self.format_traceback_part(e))
         return result
 
-    def format_traceback_part(self, e: BaseException) -> dict:
+    def format_exceptions(self, items) -> List[List[dict]]:
+        """
+        Formats many exceptions (or snapshots of exceptions) at once.
+        Tracebacks and frames are formatted as stacks.
+        The source lines of frames at the same position are only formatted once,
+        so this is faster than formatting the items separately if they share many frames.
+        """
+        return list(self._frame_layouts.iter_scope(
+            self.format_exception(item)
+            if isinstance(item, (BaseException, ExceptionSnapshot))
+            else self.format_stack(item)
+            for item in items
+        ))
+
+    def format_traceback_part(self, e: Union[BaseException, ExceptionSnapshot]) -> dict:
         return dict(
             frames=self.format_stack(e.__traceback__ or sys.exc_info()[2]),
-            exception=dict(
-                type=type(e).__name__,
-                message=some_str(e),
-            ),
+            exception=self._exception_info(e),
             tail="",
         )
 
+    @staticmethod
+    def _exception_info(e: Union[BaseException, ExceptionSnapshot]) -> dict:
+        if isinstance(e, ExceptionSnapshot):
+            return dict(type=e.type_name, message=e.message)
+        else:
+            return dict(type=type(e).__name__, message=some_str(e))
+
+    def iter_exception_json(self, e=None) -> Iterator[str]:
+        """
+        Yields pieces of JSON which together are the same as json.dumps(self.format_exception(e)).
+        Frames are formatted one at a time as the pieces are consumed,
+        so the whole result is never held in memory, even for very deep stacks.
+        """
+        if e is None:
+            e = sys.exc_info()[1]
+
+        parts = [(e, "")]
+        while self.chain:
+            first = parts[0][0]
+            if first.__cause__ is not None:
+                parts.insert(0, (first.__cause__, traceback._cause_message.strip()))
+            elif first.__context__ is not None and not first.__suppress_context__:
+                parts.insert(0, (first.__context__, traceback._context_message.strip()))
+            else:
+                break
+
+        # Find the tracebacks now, sys.exc_info() may have changed by the time they're formatted
+        parts = [
+            (exc, exc.__traceback__ or sys.exc_info()[2], tail)
+            for exc, tail in parts
+        ]
+        return self._iter_json_scopes(self._iter_exception_json(parts))
+
+    def _iter_exception_json(self, parts) -> Iterator[str]:
+        yield "["
+        for i, (e, tb, tail) in enumerate(parts):
+            if i:
+                yield ", "
+            yield '{"frames": '
+            yield from self._iter_stack_json(tb)
+            yield ', "exception": {}, "tail": {}}}'.format(
+                json.dumps(self._exception_info(e)),
+                json.dumps(tail),
+            )
+        yield "]"
+
+    def iter_stack_json(self, frame_or_tb=None) -> Iterator[str]:
+        """
+        Yields pieces of JSON which together are the same as json.dumps(self.format_stack(frame_or_tb)),
+        formatting one frame at a time. See iter_exception_json.
+        """
+        if frame_or_tb is None:
+            frame_or_tb = inspect.currentframe().f_back
+        return self._iter_json_scopes(self._iter_stack_json(frame_or_tb))
+
+    def _iter_stack_json(self, frame_or_tb) -> Iterator[str]:
+        yield "["
+        for i, item in enumerate(self.format_stack_data(self._stack_data(frame_or_tb))):
+            if i:
+                yield ", "
+            yield json.dumps(item)
+        yield "]"
+
+    def _iter_json_scopes(self, pieces: Iterator[str]) -> Iterator[str]:
+        # Remembering every repr would make memory use grow with the depth of the stack.
+        # The scopes are only current while the pieces are being computed,
+        # so a partly consumed generator doesn't affect later calls.
+        return self._repr_memo.iter_scope(self._frame_layouts.iter_scope(pieces), texts=False)
+
+    def dump_exception(self, e=None, *, file: TextIO) -> None:
+        """
+        Writes json.dumps(self.format_exception(e)) to file, one frame at a time.
+        """
+        for piece in self.iter_exception_json(e):
+            file.write(piece)
+
+    def dump_stack(self, frame_or_tb=None, *, file: TextIO) -> None:
+        """
+        Writes json.dumps(self.format_stack(frame_or_tb)) to file, one frame at a time.
+        """
+        if frame_or_tb is None:
+            frame_or_tb = inspect.currentframe().f_back
+        for piece in self.iter_stack_json(frame_or_tb):
+            file.write(piece)
+
     def format_stack(self, frame_or_tb=None) -> List[dict]:
         if frame_or_tb is None:
             frame_or_tb = inspect.currentframe().f_back
 
-        return list(
-            self.format_stack_data(
-                FrameInfo.stack_data(
-                    frame_or_tb,
-                    self.options,
-                    collapse_repeated_frames=self.collapse_repeated_frames,
-                )
-            )
+        with self._repr_memo.scope(), self._frame_layouts.scope():
+            return list(self.format_stack_data(self._stack_data(frame_or_tb)))
+
+    def _stack_data(self, frame_or_tb) -> Iterable[Union[FrameInfo, RepeatedFrames, ElidedFrames]]:
+        return FrameInfo.stack_data(
+            frame_or_tb,
+            self.options,
+            collapse_repeated_frames=self.collapse_repeated_frames,
+            keep_first_frames=self.keep_first_frames,
+            keep_last_frames=self.keep_last_frames,
+            collapse_window=self.collapse_window,
+            frame_filter=self.frame_filter,
         )
 
     def format_stack_data(
-        self, stack: Iterable[Union[FrameInfo, RepeatedFrames]]
+        self, stack: Iterable[Union[FrameInfo, RepeatedFrames, ElidedFrames]]
     ) -> Iterable[dict]:
         for item in stack:
             if isinstance(item, FrameInfo):
                 if not self.should_include_frame(item):
                     continue
                 yield dict(type="frame", **self.format_frame(item))
+            elif isinstance(item, HiddenFrames):
+                yield dict(type="hidden_frames", **self.format_hidden_frames(item))
+            elif isinstance(item, ElidedFrames):
+                yield dict(type="elided_frames", **self.format_elided_frames(item))
             else:
                 yield dict(type="repeated_frames", **self.format_repeated_frames(item))
 
@@ -139,13 +275,37 @@ class Serializer:
             ]
         )
 
-    def format_frame(self, frame: Union[FrameInfo, FrameType, TracebackType]) -> dict:
+    def format_elided_frames(self, elided_frames: ElidedFrames) -> dict:
+        return dict(count=len(elided_frames.frames))
+
+    def format_hidden_frames(self, hidden_frames: HiddenFrames) -> dict:
+        return dict(count=len(hidden_frames.frames))
+
+    def format_frame(self, frame: Union[FrameInfo, FrameType, TracebackType, FrameSnapshot]) -> dict:
         if not isinstance(frame, FrameInfo):
             frame = FrameInfo(frame, self.options)
 
-        result = dict(
+        if self._shares_frame_layouts():
+            layout = self._frame_layouts.get(
+                (frame.code, frame.lineno, frame.executing.node),
+                lambda: self._format_frame_layout(frame),
+            )
+        else:
+            layout = self._format_frame_layout(frame)
+        result = dict(layout, lines=[dict(line) for line in layout["lines"]])
+        if self.show_variables:
+            result["variables"] = list(self.format_variables(frame))
+        return result
+
+    def _shares_frame_layouts(self) -> bool:
+        if self.share_frame_layouts is not None:
+            return self.share_frame_layouts
+        return not overrides_any(self, Serializer, self._frame_layout_methods)
+
+    def _format_frame_layout(self, frame: FrameInfo) -> dict:
+        return dict(
             name=(
-                frame.executing.code_qualname()
+                frame.code_qualname
                 if self.use_code_qualname
                 else frame.code.co_name
             ),
@@ -153,9 +313,6 @@ class Serializer:
             lineno=frame.lineno,
             lines=list(self.format_lines(frame.lines)),
         )
-        if self.show_variables:
-            result["variables"] = list(self.format_variables(frame))
-        return result
 
     def format_lines(self, lines):
         for line in lines:
@@ -183,10 +340,19 @@ class Serializer:
             log.exception("Error in getting frame variables")
 
     def format_variable(self, var: Variable) -> dict:
-        return dict(
-            name=self.format_variable_part(var.name),
-            value=self.format_variable_part(self.format_variable_value(var.value)),
-        )
+        result = dict(name=self.format_variable_part(var.name))
+
+        # Within format_exception/format_stack, an object shared by several variables
+        # can be output once and then referred to by its value_id
+        identity = self.reference_repeated_values and self._repr_memo.identify(var.value)
+        if identity:
+            value_id, first = identity
+            result["value_id"] = value_id
+            if not first:
+                return result
+
+        result["value"] = self.format_variable_part(self.format_variable_value(var.value))
+        return result
 
     def format_variable_part(self, text):
         if self.html:
@@ -195,7 +361,7 @@ class Serializer:
             return text
 
     def format_variable_value(self, value) -> str:
-        return repr(value)
+        return self._repr_memo.repr(value, self.value_repr)
 
     def should_include_frame(self, frame_info: FrameInfo) -> bool:
         return True  # pragma: no cover
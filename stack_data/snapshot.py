@@ -0,0 +1,227 @@
+"""
+Picklable snapshots of frames and exceptions, so that rendering a traceback
+can be deferred to another thread or process:
+
+    snapshot = ExceptionSnapshot(e)
+    # ...later, possibly after pickling and unpickling:
+    Formatter(show_variables=True).format_exception(snapshot)
+
+Taking a snapshot only records what requires the live frames:
+the code objects, line numbers, instructions, and the reprs of local variables.
+Analysing the source code happens when the snapshot is rendered,
+so the source files must still be available (and unchanged) at that point,
+and snapshots can only be unpickled by the same version of Python.
+"""
+
+import ast
+import marshal
+import traceback
+from types import FrameType, TracebackType, CodeType
+from typing import Any, Dict, List, Optional, Union
+
+from pure_eval import is_expression_interesting
+
+from stack_data.utils import LRUCache, iter_stack, is_frame, some_str
+from stack_data.value_repr import ValueRepr
+
+# Unpickled code objects are interned so that snapshots of the same function
+# share one code object, which is how `executing` caches its analysis
+_code_objects = LRUCache(1000)
+
+
+class RenderedValue:
+    """
+    The repr of a variable's value, taken when a FrameSnapshot was created.
+    Its own repr is that text, so it can be displayed in place of the original value.
+    """
+    __slots__ = ("text",)
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def __repr__(self):
+        return self.text
+
+    def __getstate__(self):
+        return self.text
+
+    def __setstate__(self, state):
+        self.text = state
+
+
+class FrameSnapshot:
+    """
+    A picklable stand-in for a frame or traceback entry that can be passed to FrameInfo,
+    Formatter.format_frame, etc. in place of the original.
+
+    Attributes:
+        - f_code: the code object being executed
+        - f_lineno: the current line number
+        - f_lasti: the index of the current instruction
+        - f_globals: a dict containing only the module's __name__
+        - f_locals: a dict mapping the names of local variables to RenderedValues
+        - f_builtins: an empty dict
+        - f_back: the previous FrameSnapshot in the stack, if any
+    """
+
+    def __init__(
+            self,
+            code: CodeType,
+            lineno: int,
+            lasti: int,
+            module_name: Optional[str] = None,
+            local_reprs: Optional[Dict[str, str]] = None,
+    ):
+        self.f_code = code
+        self.f_lineno = lineno
+        self.f_lasti = lasti
+        self.f_globals = {"__name__": module_name}
+        self.f_locals = {
+            name: RenderedValue(text)
+            for name, text in (local_reprs or {}).items()
+        }  # type: Dict[str, RenderedValue]
+        self.f_builtins = {}  # type: Dict[str, Any]
+        self.f_back = None  # type: Optional[FrameSnapshot]
+
+    @classmethod
+    def from_frame(
+            cls,
+            frame_or_tb: Union[FrameType, TracebackType],
+            *,
+            variables: bool = True,
+            value_repr: Optional[ValueRepr] = None,
+    ) -> 'FrameSnapshot':
+        """
+        Takes a snapshot of a frame or a single traceback entry.
+
+        If variables is true, the reprs of the frame's interesting local variables
+        (not including globals) are recorded using value_repr,
+        which defaults to a new ValueRepr().
+        """
+        if is_frame(frame_or_tb):
+            frame = frame_or_tb
+            lineno = frame.f_lineno
+            lasti = frame.f_lasti
+        else:
+            frame = frame_or_tb.tb_frame
+            lineno = frame_or_tb.tb_lineno
+            lasti = frame_or_tb.tb_lasti
+
+        local_reprs = None
+        if variables and frame.f_locals is not frame.f_globals:
+            local_reprs = _local_reprs(frame, value_repr or ValueRepr())
+
+        return cls(
+            frame.f_code,
+            lineno,
+            lasti,
+            frame.f_globals.get("__name__"),
+            local_reprs,
+        )
+
+    def __repr__(self):
+        return "<{} {!r}, line {}>".format(type(self).__name__, self.f_code.co_name, self.f_lineno)
+
+    def __getstate__(self):
+        # f_back is restored by the containing ExceptionSnapshot, pickling it here
+        # would recurse too deeply for long stacks
+        return dict(
+            code=marshal.dumps(self.f_code),
+            lineno=self.f_lineno,
+            lasti=self.f_lasti,
+            module_name=self.f_globals["__name__"],
+            locals=self.f_locals,
+        )
+
+    def __setstate__(self, state):
+        code_bytes = state["code"]
+        code = _code_objects.get(code_bytes)
+        if code is None:
+            code = _code_objects[code_bytes] = marshal.loads(code_bytes)
+
+        self.f_code = code
+        self.f_lineno = state["lineno"]
+        self.f_lasti = state["lasti"]
+        self.f_globals = {"__name__": state["module_name"]}
+        self.f_locals = state["locals"]
+        self.f_builtins = {}
+        self.f_back = None
+
+
+class ExceptionSnapshot:
+    """
+    A picklable stand-in for an exception that can be passed to
+    Formatter.format_exception and Serializer.format_exception in place of the original.
+    Chained exceptions are included. See FrameSnapshot.from_frame for the keyword arguments.
+
+    Attributes:
+        - type_name: the name of the exception's class
+        - message: str() of the exception
+        - exception_only: the lines of traceback.format_exception_only()
+        - frames: a list of FrameSnapshots for the traceback, most recent call last
+        - __traceback__: the last FrameSnapshot, or None
+        - __cause__, __context__: ExceptionSnapshots of the chained exceptions, or None
+        - __suppress_context__
+    """
+
+    def __init__(
+            self,
+            e: BaseException,
+            *,
+            variables: bool = True,
+            value_repr: Optional[ValueRepr] = None,
+            _seen: Optional[Dict[int, 'ExceptionSnapshot']] = None,
+    ):
+        if _seen is None:
+            _seen = {}
+        _seen[id(e)] = self
+
+        def chained(exc):
+            if exc is None:
+                return None
+            try:
+                return _seen[id(exc)]
+            except KeyError:
+                return ExceptionSnapshot(exc, variables=variables, value_repr=value_repr, _seen=_seen)
+
+        value_repr = value_repr or ValueRepr()
+        self.type_name = type(e).__name__
+        self.message = some_str(e)
+        self.exception_only = traceback.format_exception_only(type(e), e)
+        self.frames = [
+            FrameSnapshot.from_frame(tb, variables=variables, value_repr=value_repr)
+            for tb in iter_stack(e.__traceback__)
+        ] if e.__traceback__ else []  # type: List[FrameSnapshot]
+        self._link_frames()
+        self.__suppress_context__ = e.__suppress_context__
+        self.__cause__ = chained(e.__cause__)
+        self.__context__ = chained(e.__context__)
+
+    @property
+    def __traceback__(self) -> Optional[FrameSnapshot]:
+        return self.frames[-1] if self.frames else None
+
+    def __repr__(self):
+        return "<{} {}: {}>".format(type(self).__name__, self.type_name, self.message)
+
+    def _link_frames(self):
+        previous = None
+        for frame in self.frames:
+            frame.f_back = previous
+            previous = frame
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._link_frames()
+
+
+def _local_reprs(frame: FrameType, value_repr: ValueRepr) -> Dict[str, str]:
+    result = {}
+    for name, value in frame.f_locals.items():
+        if not is_expression_interesting(ast.Name(id=name, ctx=ast.Load()), value):
+            continue
+        try:
+            result[name] = value_repr(value)
+        except Exception:
+            pass
+    return result
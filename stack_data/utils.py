@@ -1,15 +1,22 @@
 import ast
 import itertools
+import operator
+import threading
+from bisect import bisect_right
+from contextlib import contextmanager
 import types
-from collections import OrderedDict, Counter, defaultdict
+from collections import OrderedDict, Counter, defaultdict, deque
 from types import FrameType, TracebackType
 from typing import (
     Iterator, List, Tuple, Iterable, Callable, Union,
-    TypeVar, Mapping,
+    TypeVar, Mapping, Hashable, Optional, Dict, TYPE_CHECKING,
 )
 
 from asttokens import ASTText
 
+if TYPE_CHECKING:
+    from stack_data.snapshot import FrameSnapshot
+
 T = TypeVar('T')
 R = TypeVar('R')
 
@@ -46,22 +53,20 @@ def highlight_unique(lst: List[T]) -> Iterator[Tuple[T, bool]]:
 
     for is_common, group in itertools.groupby(lst, key=lambda x: counts[x] > 3):
         if is_common:
+            # Highlight the first, second, and last occurrence of each item in the group,
+            # in a single pass so that deep stacks with many distinct frames stay fast
             group = list(group)
             highlighted = [False] * len(group)
-
-            def highlight_index(f):
-                try:
-                    i = f()
-                except ValueError:
-                    return None
+            seen = {}  # type: Dict[T, int]
+            last = {}  # type: Dict[T, int]
+            for i, item in enumerate(group):
+                n = seen.get(item, 0)
+                if n < 2:
+                    highlighted[i] = True
+                    seen[item] = n + 1
+                last[item] = i
+            for i in last.values():
                 highlighted[i] = True
-                return i
-
-            for item in set(group):
-                first = highlight_index(lambda: group.index(item))
-                if first is not None:
-                    highlight_index(lambda: group.index(item, first + 1))
-                highlight_index(lambda: -1 - group[::-1].index(item))
         else:
             highlighted = itertools.repeat(True)
 
@@ -73,26 +78,108 @@ def identity(x: T) -> T:
 
 
 def collapse_repeated(lst, *, collapser, mapper=identity, key=identity):
+    lst = list(lst)
     keyed = list(map(key, lst))
+    start = 0
     for is_highlighted, group in itertools.groupby(
-            zip(lst, highlight_unique(keyed)),
-            key=lambda t: t[1][1],
+            highlight_unique(keyed),
+            key=operator.itemgetter(1),
     ):
-        original_group, highlighted_group = zip(*group)
+        end = start + sum(1 for _ in group)
         if is_highlighted:
-            yield from map(mapper, original_group)
+            yield from map(mapper, lst[start:end])
+        else:
+            yield collapser(lst[start:end], keyed[start:end])
+        start = end
+
+
+def collapse_repeated_streaming(iterable, *, collapser, mapper=identity, key=identity, window=100):
+    """
+    Like collapse_repeated, but consumes the iterable lazily, looking at most `window` items ahead
+    of the item being yielded, so the first results are available immediately.
+    If the window covers the whole iterable, the results are the same as collapse_repeated.
+    Otherwise, items are treated as common if they occur more than 3 times in what has been
+    seen so far plus the window, and the last occurrence of an item in a collapsed run is
+    guessed from the window, so somewhat more items may be shown.
+    """
+    iterator = iter(iterable)
+    exhausted = False
+    buffer = deque()  # (item, key) pairs, the first is the next to be yielded
+    start = 0  # position of buffer[0] in the iterable
+    positions = {}  # type: Dict[Hashable, deque]  # key -> positions in the buffer
+    taken = Counter()  # key -> number of items removed from the buffer
+    run_counts = Counter()  # key -> number of items in the current run of common items
+    # Every item in the buffer before this position is known to be common
+    boundary = 0
+    collapsed_items, collapsed_keys = [], []
+
+    def known_count(k):
+        return taken[k] + len(positions.get(k, ()))
+
+    def flush():
+        if collapsed_items:
+            yield collapser(collapsed_items[:], collapsed_keys[:])
+            collapsed_items.clear()
+            collapsed_keys.clear()
+
+    while True:
+        while not exhausted and len(buffer) <= window:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                exhausted = True
+                break
+            k = key(item)
+            positions.setdefault(k, deque()).append(start + len(buffer))
+            buffer.append((item, k))
+
+        if not buffer:
+            break
+
+        # Counts only grow as more items are seen, so the boundary only moves forward
+        boundary = max(boundary, start)
+        while boundary < start + len(buffer) and known_count(buffer[boundary - start][1]) > 3:
+            boundary += 1
+        is_common = boundary > start
+
+        item, k = buffer.popleft()
+        item_positions = positions[k]
+        item_positions.popleft()
+        if not item_positions:
+            del positions[k]
+        taken[k] += 1
+        start += 1
+
+        if not is_common:
+            yield from flush()
+            run_counts.clear()
+            yield mapper(item)
+            continue
+
+        run_counts[k] += 1
+        is_last_in_run = not item_positions or item_positions[0] >= boundary
+        if run_counts[k] <= 2 or is_last_in_run:
+            yield from flush()
+            yield mapper(item)
         else:
-            keyed_group, _ = zip(*highlighted_group)
-            yield collapser(list(original_group), list(keyed_group))
+            collapsed_items.append(item)
+            collapsed_keys.append(k)
+
+    yield from flush()
 
 
-def is_frame(frame_or_tb: Union[FrameType, TracebackType]) -> bool:
-    assert_(isinstance(frame_or_tb, (types.FrameType, types.TracebackType)))
-    return isinstance(frame_or_tb, (types.FrameType,))
+def is_frame(frame_or_tb: Union[FrameType, TracebackType, 'FrameSnapshot']) -> bool:
+    if isinstance(frame_or_tb, types.TracebackType):
+        return False
+    # Stand-ins for frames such as stack_data.snapshot.FrameSnapshot are also accepted
+    assert_(isinstance(frame_or_tb, types.FrameType) or hasattr(frame_or_tb, "f_code"))
+    return True
 
 
-def iter_stack(frame_or_tb: Union[FrameType, TracebackType]) -> Iterator[Union[FrameType, TracebackType]]:
-    current: Union[FrameType, TracebackType, None] = frame_or_tb
+def iter_stack(
+        frame_or_tb: Union[FrameType, TracebackType, 'FrameSnapshot'],
+) -> Iterator[Union[FrameType, TracebackType, 'FrameSnapshot']]:
+    current: Union[FrameType, TracebackType, 'FrameSnapshot', None] = frame_or_tb
     while current:
         yield current
         if is_frame(current):
@@ -101,7 +188,9 @@ def iter_stack(frame_or_tb: Union[FrameType, TracebackType]) -> Iterator[Union[F
             current = current.tb_next
 
 
-def frame_and_lineno(frame_or_tb: Union[FrameType, TracebackType]) -> Tuple[FrameType, int]:
+def frame_and_lineno(
+        frame_or_tb: Union[FrameType, TracebackType, 'FrameSnapshot'],
+) -> Tuple[Union[FrameType, 'FrameSnapshot'], int]:
     if is_frame(frame_or_tb):
         return frame_or_tb, frame_or_tb.f_lineno
     else:
@@ -126,6 +215,46 @@ def group_by_key_func(iterable: Iterable[T], key_func: Callable[[T], R]) -> Mapp
     return result
 
 
+def node_structure(node: ast.AST, memo: Optional[dict] = None) -> Hashable:
+    """
+    A hashable representation of the structure of an AST node,
+    such that two nodes have the same structure if and only if
+    their source code would parse to the same expression.
+    Positions and expression contexts (Load/Store/Del) are ignored,
+    and function arguments are treated like the equivalent names.
+
+    `memo` can be a dict shared between calls on nodes of the same tree
+    to avoid recomputing the structure of common subtrees.
+    """
+    if memo is None:
+        memo = {}
+
+    def structure(n):
+        if isinstance(n, ast.AST):
+            try:
+                return memo[id(n)]
+            except KeyError:
+                pass
+
+            if isinstance(n, ast.arg):
+                result = ("Name", repr(n.arg))
+            else:
+                result = (type(n).__name__,) + tuple(
+                    structure(getattr(n, field, None))
+                    for field in n._fields
+                    if field != "ctx"
+                )
+            memo[id(n)] = result
+            return result
+        elif isinstance(n, list):
+            return tuple(structure(x) for x in n)
+        else:
+            # repr distinguishes e.g. 1, 1.0 and True which compare equal
+            return repr(n)
+
+    return structure(node)
+
+
 class cached_property(object):
     """
     A property that is only computed once per instance and then replaces itself
@@ -148,20 +277,170 @@ class cached_property(object):
     __get__ = cached_property_wrapper
 
 
-def _pygmented_with_ranges(formatter, code, ranges):
-    import pygments
+class ScopedCache:
+    """
+    A dict that's only used inside a `with cache.scope():` block in the current thread,
+    e.g. for the duration of one call of Formatter.format_exception.
+    Nested scopes share the outermost one, and the contents are discarded when it exits.
+
+    Generators should use iter_scope instead, so that the scope isn't left open
+    while they're suspended, or forever if they're abandoned.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _new_cache(self, **options) -> dict:
+        return {}
+
+    @contextmanager
+    def scope(self, **options):
+        if self.current is not None:
+            # Nested scope, e.g. format_stack called by format_exception
+            yield
+            return
+
+        self._local.cache = self._new_cache(**options)
+        try:
+            yield
+        finally:
+            self._local.cache = None
+
+    def iter_scope(self, iterable: Iterable[T], **options) -> Iterator[T]:
+        """
+        Yields the items of iterable, which are computed inside a scope of their own.
+        The scope is only current while the next item is being computed,
+        so a suspended generator doesn't affect other calls in the same thread,
+        and its contents are discarded along with it.
+        If there's already a current scope when iteration starts, that one is used.
+        """
+        if self.current is not None:
+            yield from iterable
+            return
+
+        cache = self._new_cache(**options)
+        iterator = iter(iterable)
+        while True:
+            self._local.cache = cache
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._local.cache = None
+            yield item
+
+    @property
+    def current(self) -> Optional[dict]:
+        """
+        The dict of the current scope, or None outside of a scope.
+        """
+        return getattr(self._local, "cache", None)
+
+    def get(self, key, compute: Callable[[], T]) -> T:
+        """
+        Returns the value for the key in the current scope, calling compute() if it's missing.
+        Outside of a scope, just returns compute().
+        """
+        cache = self.current
+        if cache is None:
+            return compute()
+        try:
+            return cache[key]
+        except KeyError:
+            result = cache[key] = compute()
+            return result
+
+
+class LRUCache:
+    """
+    A mapping-like cache holding at most maxsize items,
+    discarding the least recently used items first.
+    It's safe to use from multiple threads.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()  # type: OrderedDict
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def values(self):
+        with self._lock:
+            return list(self._data.values())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+_executing_node_lexer_class = None
+
+
+def _get_executing_node_lexer_class():
+    """
+    A Python lexer class which marks tokens inside the ranges given to the constructor
+    with the ExecutingNode token type.
+    It's only created once because pygments compiles the regexes of each lexer class
+    the first time it's instantiated.
+    """
+    global _executing_node_lexer_class
+    if _executing_node_lexer_class is not None:
+        return _executing_node_lexer_class
+
     from pygments.lexers import get_lexer_by_name
 
-    class MyLexer(type(get_lexer_by_name("python3"))):
+    class ExecutingNodeLexer(type(get_lexer_by_name("python3"))):
+        def __init__(self, ranges, **options):
+            super().__init__(**options)
+            ranges = sorted(ranges)
+            self.range_starts = [start for start, _ in ranges]
+            # The furthest end of any range starting at or before each range,
+            # in case ranges overlap
+            self.max_range_ends = list(itertools.accumulate((end for _, end in ranges), max))
+
+        def in_ranges(self, position):
+            # Find the last range starting at or before position
+            i = bisect_right(self.range_starts, position) - 1
+            return i >= 0 and position < self.max_range_ends[i]
+
         def get_tokens(self, text):
             length = 0
             for ttype, value in super().get_tokens(text):
-                if any(start <= length < end for start, end in ranges):
+                if self.range_starts and self.in_ranges(length):
                     ttype = ttype.ExecutingNode
                 length += len(value)
                 yield ttype, value
 
-    lexer = MyLexer(stripnl=False)
+    _executing_node_lexer_class = ExecutingNodeLexer
+    return ExecutingNodeLexer
+
+
+def _pygmented_with_ranges(formatter, code, ranges):
+    import pygments
+
+    lexer = _get_executing_node_lexer_class()(ranges, stripnl=False)
     try:
         highlighted = pygments.highlight(code, lexer, formatter)
     except Exception:
@@ -170,6 +449,14 @@ def _pygmented_with_ranges(formatter, code, ranges):
     return highlighted.splitlines()
 
 
+def overrides_any(obj, base: type, names: Iterable[str]) -> bool:
+    """
+    Returns True if the class of obj has replaced any of the named attributes of base.
+    """
+    cls = type(obj)
+    return any(getattr(cls, name) is not getattr(base, name) for name in names)
+
+
 def assert_(condition, error=""):
     if not condition:
         if isinstance(error, str):
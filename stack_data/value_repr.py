@@ -0,0 +1,378 @@
+import builtins
+import inspect
+import reprlib
+import sys
+import threading
+import time
+from collections import deque, defaultdict, namedtuple, Counter, OrderedDict
+from itertools import islice
+from typing import Any, Callable, List, Optional, Tuple
+
+from stack_data.utils import truncate, ScopedCache
+
+Summarizer = Callable[['ValueRepr', Any], Optional[str]]
+
+
+class ValueRepr(reprlib.Repr):
+    """
+    A bounded repr for the values of variables, used by Formatter and Serializer,
+    so that displaying a frame holding e.g. a huge bytes object, list or array
+    doesn't take a long time or produce a huge amount of output.
+
+    - max_length: the maximum length of the result, and of each string or number in it.
+    - max_depth: the maximum depth of nested containers that are shown.
+    - max_items: the maximum number of items shown in each container.
+    - time_budget: if not None, the number of seconds after which
+        any remaining values are replaced by '...'.
+        This can't interrupt a single slow __repr__ method.
+
+    Before the usual repr, each function in .summarizers is called with
+    this object and the value, and the first result that isn't None is used.
+    This allows registering cheap summaries for heavy types, e.g.:
+
+        value_repr = ValueRepr()
+        value_repr.summarizers.append(
+            lambda r, x: "<Model {}>".format(x.id) if isinstance(x, Model) else None
+        )
+    """
+
+    def __init__(
+            self, *,
+            max_length: int = 1000,
+            max_depth: int = 6,
+            max_items: int = 100,
+            time_budget: Optional[float] = None
+    ):
+        super().__init__()
+        self.max_length = max_length
+        self.max_depth = max_depth
+        self.max_items = max_items
+        self.time_budget = time_budget
+        self.summarizers = list(default_summarizers)  # type: List[Summarizer]
+
+        self.maxlevel = max_depth
+        self.maxtuple = self.maxlist = self.maxarray = self.maxdict = \
+            self.maxset = self.maxfrozenset = self.maxdeque = max_items
+        self.maxstring = self.maxlong = self.maxother = max_length
+        # The deadline of the current call in each thread, as one ValueRepr
+        # may be used by several threads at once, e.g. by a BackgroundWorker
+        self._local = threading.local()
+
+    def __call__(self, value) -> str:
+        return self.repr(value)
+
+    def repr(self, x) -> str:
+        outer_deadline = self._deadline
+        if outer_deadline is None and self.time_budget is not None:
+            self._local.deadline = time.perf_counter() + self.time_budget
+        try:
+            result = self.repr1(x, self.maxlevel)
+        finally:
+            self._local.deadline = outer_deadline
+        return truncate(result, self.max_length, "...")
+
+    @property
+    def _deadline(self) -> Optional[float]:
+        return getattr(self._local, "deadline", None)
+
+    def repr1(self, x, level: int) -> str:
+        deadline = self._deadline
+        if deadline is not None and time.perf_counter() > deadline:
+            return "..."
+
+        for summarizer in self.summarizers:
+            result = summarizer(self, x)
+            if result is not None:
+                return result
+
+        cls = type(x)
+        if cls not in _container_types and isinstance(x, _container_types):
+            return self._repr_container_subclass(x, level)
+
+        return super().repr1(x, level)
+
+    def _repr_container_subclass(self, x, level):
+        # reprlib only bounds instances of the builtin types themselves,
+        # so e.g. a small defaultdict of huge lists would be rendered in full.
+        # Subclasses that use the repr of a builtin or standard library container
+        # get a bounded imitation of it, others use their own __repr__.
+        cls = type(x)
+        method = _container_repr_methods.get(cls.__repr__)
+        if method is None and issubclass(cls, tuple) and \
+                getattr(cls.__repr__, '__code__', None) is _namedtuple_repr_code:
+            method = '_repr_namedtuple'
+        if method is None:
+            return self.repr_instance(x, level)
+        return getattr(self, method)(x, level)
+
+    def _repr_named(self, x, level, left, right, maxiter):
+        # Like the reprs of set and deque subclasses, e.g. MySet({1, 2})
+        name = type(x).__name__
+        if not x:
+            return name + '()'
+        return name + '(' + self._repr_set_items(x, level, left, right, maxiter) + ')'
+
+    def _repr_set_subclass(self, x, level):
+        return self._repr_named(x, level, '{', '}', self.maxset)
+
+    def repr_deque(self, x, level):
+        # Unlike reprlib, include maxlen like the builtin repr
+        name = type(x).__name__
+        result = name + '(' + self._repr_set_items(x, level, '[', ']', self.maxdeque)
+        if x.maxlen is not None:
+            result += ', maxlen=%d' % x.maxlen
+        return result + ')'
+
+    def _repr_defaultdict(self, x, level):
+        return '%s(%s, %s)' % (
+            type(x).__name__,
+            self.repr1(x.default_factory, level - 1),
+            self.repr_dict(x, level),
+        )
+
+    def _repr_counter(self, x, level):
+        name = type(x).__name__
+        if not x:
+            return name + '()'
+        try:
+            items = x.most_common(self.maxdict)
+        except TypeError:
+            # Counts that can't be sorted
+            return '%s(%s)' % (name, self.repr_dict(x, level))
+        if level <= 0:
+            return name + '({...})'
+        pieces = [
+            '%s: %s' % (self.repr1(key, level - 1), self.repr1(count, level - 1))
+            for key, count in items
+        ]
+        if len(x) > self.maxdict:
+            pieces.append('...')
+        return '%s({%s})' % (name, ', '.join(pieces))
+
+    def _repr_ordered_dict(self, x, level):
+        name = type(x).__name__
+        if not x:
+            return name + '()'
+        if sys.version_info >= (3, 12):
+            return '%s(%s)' % (name, self.repr_dict(x, level))
+        if level <= 0:
+            return name + '([...])'
+        pieces = [
+            '(%s, %s)' % (self.repr1(key, level - 2), self.repr1(value, level - 2))
+            for key, value in islice(x.items(), self.maxdict)
+        ]
+        if len(x) > self.maxdict:
+            pieces.append('...')
+        return '%s([%s])' % (name, ', '.join(pieces))
+
+    def _repr_namedtuple(self, x, level):
+        name = type(x).__name__
+        if level <= 0:
+            return name + '(...)'
+        return '%s(%s)' % (name, ', '.join(
+            '%s=%s' % (field, self.repr1(value, level - 1))
+            for field, value in zip(type(x)._fields, x)
+        ))
+
+    # reprlib sorts the items of sets and dicts, unlike the builtin repr
+
+    def repr_dict(self, x, level):
+        n = len(x)
+        if n == 0:
+            return '{}'
+        if level <= 0:
+            return '{...}'
+        newlevel = level - 1
+        pieces = [
+            '%s: %s' % (self.repr1(key, newlevel), self.repr1(value, newlevel))
+            for key, value in islice(x.items(), self.maxdict)
+        ]
+        if n > self.maxdict:
+            pieces.append('...')
+        return '{%s}' % ', '.join(pieces)
+
+    def _repr_set_items(self, x, level, left, right, maxiter):
+        if level <= 0:
+            return left + '...' + right
+        pieces = [self.repr1(item, level - 1) for item in islice(x, maxiter)]
+        if len(x) > maxiter:
+            pieces.append('...')
+        return left + ', '.join(pieces) + right
+
+    def repr_set(self, x, level):
+        if not x:
+            return 'set()'
+        return self._repr_set_items(x, level, '{', '}', self.maxset)
+
+    def repr_frozenset(self, x, level):
+        if not x:
+            return 'frozenset()'
+        return self._repr_set_items(x, level, 'frozenset({', '})', self.maxfrozenset)
+
+    def repr_int(self, x, level):
+        try:
+            return super().repr_int(x, level)
+        except ValueError:
+            # Exceeds the limit for integer string conversion
+            return '<int with {} bits>'.format(x.bit_length())
+
+    def repr_instance(self, x, level):
+        # Unlike reprlib, let exceptions propagate like the builtin repr
+        return truncate(builtins.repr(x), self.maxother, '...')
+
+
+def summarize_bytes(value_repr: ValueRepr, x) -> Optional[str]:
+    """
+    Truncates bytes and bytearrays like reprlib truncates strings,
+    without converting the whole object like repr would.
+    """
+    if not isinstance(x, (bytes, bytearray)):
+        return None
+
+    max_length = value_repr.max_length
+    if len(x) <= max_length:
+        return None
+
+    return truncate(repr(x[:max_length]), max_length, '...')
+
+
+_container_types = (list, tuple, set, frozenset, dict, deque)
+
+# Methods of ValueRepr imitating the __repr__ methods of containers, for their subclasses
+_container_repr_methods = {
+    list.__repr__: 'repr_list',
+    tuple.__repr__: 'repr_tuple',
+    dict.__repr__: 'repr_dict',
+    set.__repr__: '_repr_set_subclass',
+    frozenset.__repr__: '_repr_set_subclass',
+    deque.__repr__: 'repr_deque',
+    defaultdict.__repr__: '_repr_defaultdict',
+    Counter.__repr__: '_repr_counter',
+    OrderedDict.__repr__: '_repr_ordered_dict',
+}
+
+# Every class made by namedtuple() gets a new __repr__ function, but they share this code
+_namedtuple_repr_code = namedtuple('_', '').__repr__.__code__
+
+
+def summarize_large_container(value_repr: ValueRepr, x) -> Optional[str]:
+    """
+    Summarizes instances of subclasses of builtin containers, e.g. defaultdict or Counter,
+    with too many items. reprlib only truncates instances of the builtin types themselves.
+    """
+    cls = type(x)
+    if cls in _container_types or not isinstance(x, _container_types):
+        return None
+
+    n = len(x)
+    if n <= value_repr.max_items:
+        return None
+
+    return '<{} with {} items>'.format(cls.__name__, n)
+
+
+def summarize_array(value_repr: ValueRepr, x) -> Optional[str]:
+    """
+    Summarizes large numpy arrays, pandas dataframes, and other objects
+    with a shape and a dtype (or dtypes) by their shape instead of their contents.
+    """
+    # Look up attributes on the type to avoid triggering __getattr__ on arbitrary objects
+    cls = type(x)
+    if not inspect.isdatadescriptor(getattr(cls, 'shape', None)):
+        return None
+    if not (hasattr(cls, 'dtype') or hasattr(cls, 'dtypes')):
+        return None
+
+    try:
+        shape = tuple(x.shape)
+        size = 1
+        for dim in shape:
+            size *= dim
+    except Exception:
+        return None
+
+    if size <= value_repr.max_items:
+        return None
+
+    result = '<{} shape={}'.format(cls.__name__, shape)
+    if hasattr(cls, 'dtype'):
+        result += ' dtype={}'.format(x.dtype)
+    return result + '>'
+
+
+default_summarizers = [
+    summarize_bytes,
+    summarize_large_container,
+    summarize_array,
+]  # type: List[Summarizer]
+
+
+class ReprMemo(ScopedCache):
+    """
+    Remembers the reprs of objects during one call of e.g. Formatter.format_exception,
+    so that an object shared by many frames (e.g. a request or self) is only rendered once.
+
+    Memoization only happens inside a `with memo.scope():` block in the current thread,
+    or while memo.iter_scope() is computing an item (see ScopedCache).
+    Objects are keyed by id, so references to them are held until the scope ends
+    to ensure that ids aren't reused by other objects in the meantime.
+    """
+
+    def _new_cache(self, *, texts: bool = True) -> dict:
+        """
+        The options of scope() and iter_scope():
+        if texts is false, reprs aren't remembered, only the objects passed to identify(),
+        so that memory use doesn't grow with every object rendered, e.g. when streaming.
+        """
+        return _MemoEntries(texts)
+
+    def _entry(self, value) -> Optional['_MemoEntry']:
+        entries = self.current
+        if entries is None:
+            return None
+        try:
+            return entries[id(value)]
+        except KeyError:
+            entry = entries[id(value)] = _MemoEntry(value, len(entries))
+            return entry
+
+    def repr(self, value, render: Callable[[Any], str]) -> str:
+        """
+        Returns render(value), calling it only once per object within a scope.
+        """
+        entries = self.current
+        if entries is None or not entries.texts:
+            return render(value)
+        entry = self._entry(value)
+        if entry.text is None:
+            entry.text = render(value)
+        return entry.text
+
+    def identify(self, value) -> Optional[Tuple[int, bool]]:
+        """
+        Returns a pair (index, first) where index is a number identifying the object
+        within the current scope, and first is true the first time it's identified.
+        Returns None outside of a scope.
+        """
+        entry = self._entry(value)
+        if entry is None:
+            return None
+        first = not entry.identified
+        entry.identified = True
+        return entry.index, first
+
+
+class _MemoEntries(dict):
+    def __init__(self, texts: bool):
+        super().__init__()
+        self.texts = texts
+
+
+class _MemoEntry:
+    __slots__ = ("value", "index", "text", "identified")
+
+    def __init__(self, value, index: int):
+        self.value = value  # Keeps the object alive so that its id isn't reused
+        self.index = index
+        self.text = None  # type: Optional[str]
+        self.identified = False
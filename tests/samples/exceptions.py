@@ -0,0 +1,31 @@
+def recurse(n):
+    lst = [n] * 3
+    if n == 0:
+        raise ValueError("boom")
+    return recurse(n - 1)
+
+
+def get_exception():
+    try:
+        try:
+            recurse(5)
+        except ValueError:
+            str(1 / 0)
+    except ZeroDivisionError as e:
+        return e
+
+
+def get_exceptions():
+    def inner(x):
+        raise ValueError(x)
+
+    def outer(x):
+        inner(x)
+
+    exceptions = []
+    for x in range(3):
+        try:
+            outer(x)
+        except ValueError as e:
+            exceptions.append(e)
+    return exceptions
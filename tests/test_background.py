@@ -0,0 +1,114 @@
+import os
+import threading
+from io import StringIO
+
+import pytest
+
+from stack_data import Formatter
+from stack_data.background import BackgroundWorker
+
+
+def blocked_worker(**kwargs):
+    worker = BackgroundWorker(**kwargs)
+    release = threading.Event()
+    started = threading.Event()
+
+    def block():
+        started.set()
+        release.wait()
+
+    worker.submit(block)
+    started.wait()
+    return worker, release
+
+
+@pytest.mark.parametrize("overflow,expected", [
+    ("drop_new", [0, 1]),
+    ("drop_old", [2, 3]),
+])
+def test_overflow(overflow, expected):
+    worker, release = blocked_worker(max_queue=2, overflow=overflow)
+    results = []
+    submitted = [worker.submit(lambda i=i: results.append(i)) for i in range(4)]
+    assert worker.dropped == 2
+    assert submitted == ([True, True, False, False] if overflow == "drop_new" else [True] * 4)
+
+    release.set()
+    assert worker.flush(timeout=5)
+    assert results == expected
+
+
+def test_block():
+    worker, release = blocked_worker(max_queue=1, overflow="block")
+    results = []
+    worker.submit(lambda: results.append(0))
+
+    thread = threading.Thread(target=worker.submit, args=(lambda: results.append(1),))
+    thread.start()
+    thread.join(0.05)
+    assert thread.is_alive()
+
+    release.set()
+    thread.join(5)
+    assert worker.flush(timeout=5)
+    assert results == [0, 1]
+    assert worker.dropped == 0
+
+
+def test_flush_timeout():
+    worker, release = blocked_worker()
+    assert not worker.flush(timeout=0.01)
+    release.set()
+    assert worker.flush(timeout=5)
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+def test_fork():
+    worker, release = blocked_worker()
+    worker.submit(lambda: None)
+    read_fd, write_fd = os.pipe()
+
+    pid = os.fork()
+    if pid == 0:  # pragma: no cover
+        code = 1
+        try:
+            worker.submit(lambda: os.write(write_fd, b"child"))
+            if worker.flush(timeout=5):
+                code = 0
+        finally:
+            os._exit(code)
+
+    os.close(write_fd)
+    _, status = os.waitpid(pid, 0)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+    assert os.read(read_fd, 100) == b"child"
+    os.close(read_fd)
+
+    release.set()
+    assert worker.flush(timeout=5)
+
+
+def test_invalid_overflow():
+    with pytest.raises(ValueError):
+        BackgroundWorker(overflow="explode")
+
+
+def test_background_print_exception():
+    def foo():
+        x = [1, 2]
+        raise ValueError(x)
+
+    for show_variables in [False, True]:
+        formatter = Formatter(show_variables=show_variables)
+        try:
+            foo()
+        except ValueError as e:
+            expected = "".join(Formatter().format_exception(e))
+            file = StringIO()
+            formatter.print_exception(file=file, background=True)
+
+        assert formatter.background_worker.flush(timeout=10)
+        if show_variables:
+            assert "x = [1, 2]\n" in file.getvalue()
+        else:
+            assert file.getvalue() == expected
@@ -4,6 +4,8 @@ import os
 import re
 import sys
 import token
+import types
+import zipfile
 from itertools import islice
 from pathlib import Path
 
@@ -13,9 +15,11 @@ from executing import only
 # noinspection PyUnresolvedReferences
 from pygments.formatters.html import HtmlFormatter
 from pygments.lexers import Python3Lexer
-from stack_data import Options, Line, LINE_GAP, markers_from_ranges, Variable, RangeInLine, style_with_executing_node
-from stack_data import Source, FrameInfo
-from stack_data.utils import line_range
+from stack_data import Options, Line, LINE_GAP, markers_from_ranges, Variable, RangeInLine, style_with_executing_node, BlankLines
+from stack_data import Source, FrameInfo, SourceCache, VariableSelection, FrozenOptions, Formatter, \
+    Serializer, ElidedFrames, RepeatedFrames
+from stack_data.core import TokenIndex
+from stack_data.utils import line_range, group_by_key_func, _pygmented_with_ranges, node_structure
 
 samples_dir = Path(__file__).parent / "samples"
 pygments_version = tuple(map(int, pygments.__version__.split(".")[:2]))
@@ -209,7 +213,9 @@ def test_variables():
     assert repr(options) == ('Options(after=0, before=1, ' +
                              'blank_lines=<BlankLines.HIDDEN: 1>,' +
                              ' include_signature=False, ' +
-                             'max_lines_per_piece=6, pygments_formatter=None)')
+                             'max_lines_per_piece=6, max_variables=None, ' +
+                             'pygments_formatter=None, ' +
+                             'variables=<VariableSelection.SCOPE: 1>)')
 
     def foo(arg, _arg2: str = None, *_args, **_kwargs):
         y = 123986
@@ -316,6 +322,57 @@ def test_variables():
             [*variables[3:6], variables[7]]
     )
 
+    def names(variables):
+        return sorted(var.name for var in variables)
+
+    for selection, expected in [
+        (VariableSelection.LINES, frame_info.variables_in_lines),
+        (VariableSelection.EXECUTING_PIECE, frame_info.variables_in_executing_piece),
+    ]:
+        options = Options(before=1, after=0, variables=selection)
+        assert names(foo('this is arg').variables) == names(expected)
+
+    options = Options(before=1, after=0, max_variables=3)
+    assert names(foo('this is arg').variables) == ['str(y)', 'x', 'y']
+
+
+def test_frozen_options():
+    options = Options(before=1, blank_lines=BlankLines.VISIBLE)
+    frozen = options.freeze()
+    assert isinstance(frozen, FrozenOptions)
+    assert repr(frozen) == repr(options).replace("Options(", "FrozenOptions(")
+    assert frozen == Options(before=1, blank_lines=BlankLines.VISIBLE).freeze()
+    assert hash(frozen) == hash(options.freeze())
+    assert frozen != options.replace(before=2).freeze()
+    assert frozen.freeze() is frozen
+    assert frozen.replace(after=5).after == 5
+    assert frozen.after == 1
+    with pytest.raises(AttributeError):
+        frozen.before = 2
+
+    # Formatter sets the pygments formatter without mutating the frozen options
+    formatter = Formatter(options=frozen, pygmented=True)
+    assert formatter.options.pygments_formatter is not None
+    assert frozen.pygments_formatter is None
+
+
+def test_layout_cache():
+    def foo(options):
+        return FrameInfo(inspect.currentframe(), options)
+
+    options = Options(before=0, after=0)
+    frame_info = foo(options)
+    other = foo(options.freeze())
+    assert other._layout is frame_info._layout
+    assert other.lines is not frame_info.lines
+    assert other.lines[0].frame_info is other
+    assert [line.lineno for line in other.lines] == [line.lineno for line in frame_info.lines]
+    assert other.included_pieces == frame_info.included_pieces
+
+    different = foo(Options(before=1, after=0))
+    assert different._layout is not frame_info._layout
+    assert len(different.lines) > len(frame_info.lines)
+
 
 def test_pieces():
     filename = samples_dir / "pieces.py"
@@ -480,6 +537,186 @@ def test_skipping_frames():
     check_skipping_frames(False)
 
 
+def test_elided_frames():
+    def recurse(n):
+        if n == 0:
+            raise ValueError
+        recurse(n - 1)
+
+    try:
+        recurse(50)
+    except ValueError as exc:
+        e = exc
+    tb = e.__traceback__
+
+    class CountingFrameInfo(FrameInfo):
+        created = 0
+
+        def __init__(self, *args, **kwargs):
+            CountingFrameInfo.created += 1
+            super().__init__(*args, **kwargs)
+
+    result = list(CountingFrameInfo.stack_data(
+        tb, collapse_repeated_frames=False, keep_first_frames=2, keep_last_frames=3,
+    ))
+    assert CountingFrameInfo.created == 5
+    assert [type(x) for x in result] == [CountingFrameInfo] * 2 + [ElidedFrames] + [CountingFrameInfo] * 3
+    assert result[0].code.co_name == "test_elided_frames"
+    assert repr(result[2]) == "<ElidedFrames 47 frames>"
+    assert len(result[2].frames) == 47
+
+    # Repeated frames are still collapsed in the frames that are kept
+    result = list(FrameInfo.stack_data(tb, keep_last_frames=20))
+    assert [type(x) for x in result] == [ElidedFrames] + [FrameInfo] * 2 + [RepeatedFrames] + [FrameInfo] * 2
+    assert len(result[0].frames) == 32
+
+    # Nothing is elided if the stack is short enough
+    result = list(FrameInfo.stack_data(tb, collapse_repeated_frames=False, keep_first_frames=30, keep_last_frames=30))
+    assert [type(x) for x in result] == [FrameInfo] * 52
+
+    formatted = "".join(Formatter(keep_first_frames=1, keep_last_frames=1).format_exception(e))
+    assert "    [... skipping 50 frames]\n" in formatted
+    assert formatted.count(" File ") == 2
+
+    serialized = Serializer(keep_first_frames=0, keep_last_frames=1).format_exception(e)
+    frames = serialized[0]["frames"]
+    assert frames[0] == dict(type="elided_frames", count=51)
+    assert [f["type"] for f in frames] == ["elided_frames", "frame"]
+
+
+def test_collapse_window():
+    e = get_recursion_error()
+    expected = [repr(x) for x in FrameInfo.stack_data(e.__traceback__)]
+    assert [repr(x) for x in FrameInfo.stack_data(e.__traceback__, collapse_window=5)] == expected
+
+    stack = FrameInfo.stack_data(e.__traceback__, collapse_window=5)
+    assert next(stack).code.co_name == "get_recursion_error"
+    assert "skipping similar frames" in "".join(Formatter(collapse_window=5).format_exception(e))
+
+
+@pytest.mark.skipif(not hasattr(FrameInfo.__init__.__code__, "co_qualname"), reason="needs co_qualname")
+def test_headers_without_source(monkeypatch):
+    e = get_recursion_error()
+    stack = list(FrameInfo.stack_data(e.__traceback__))
+
+    def fail(*args, **kwargs):
+        raise AssertionError("Source was read")
+
+    monkeypatch.setattr(Source, "for_filename", fail)
+    monkeypatch.setattr(Source, "executing", fail)
+
+    repeated = stack[3]
+    assert repeated.description == "get_recursion_error.<locals>.recurse at line {} (97 times)".format(
+        repeated.frame_keys[0][1]
+    )
+    frame_info = stack[-1]
+    assert frame_info.code_qualname == "get_recursion_error.<locals>.recurse"
+    assert Formatter().format_frame_header(frame_info) == (
+        ' File "{}", line {}, in get_recursion_error.<locals>.recurse\n'.format(__file__, frame_info.lineno)
+    )
+
+
+def test_code_qualname_from_loader(monkeypatch, tmp_path):
+    # The source of a zipped module is only available from its loader
+    zip_path = tmp_path / "zipped.zip"
+    with zipfile.ZipFile(str(zip_path), "w") as zf:
+        zf.writestr("zipped_module.py", (
+            "import inspect\n"
+            "class A:\n"
+            "    def f(self, n):\n"
+            "        if n:\n"
+            "            return self.f(n - 1)\n"
+            "        return inspect.currentframe()\n"
+        ))
+    monkeypatch.syspath_prepend(str(zip_path))
+    monkeypatch.delitem(sys.modules, "zipped_module", raising=False)
+    import zipped_module
+
+    frame = zipped_module.A().f(5)
+    assert FrameInfo(frame).code_qualname == "A.f"
+    stack = list(FrameInfo.stack_data(frame, collapse_repeated_frames=True))
+    repeated = [item for item in stack if isinstance(item, RepeatedFrames)]
+    assert repeated[0].description.startswith("A.f at line 5 ")
+
+
+def test_filename_cache(monkeypatch, tmp_path):
+    (tmp_path / "relative_module.py").write_text("import inspect\nframe = inspect.currentframe()\n")
+    relative = compile((tmp_path / "relative_module.py").read_text(), "relative_module.py", "exec")
+    missing = compile("import inspect\nframe = inspect.currentframe()\n", "missing_module.py", "exec")
+
+    def frame_for(code):
+        namespace = {}
+        exec(code, namespace)
+        return namespace["frame"]
+
+    isfile_calls = []
+    isfile = os.path.isfile
+
+    def counting_isfile(path):
+        isfile_calls.append(path)
+        return isfile(path)
+
+    monkeypatch.setattr(os.path, "isfile", counting_isfile)
+    monkeypatch.chdir(tmp_path)
+
+    assert FrameInfo(frame_for(relative)).filename == str(tmp_path / "relative_module.py")
+    assert len(isfile_calls) == 1
+    assert FrameInfo(frame_for(relative)).filename == str(tmp_path / "relative_module.py")
+    assert len(isfile_calls) == 1
+
+    # Names that can't be found are also cached
+    assert FrameInfo(frame_for(missing)).filename == "missing_module.py"
+    calls = len(isfile_calls)
+    assert calls > 2
+    assert FrameInfo(frame_for(missing)).filename == "missing_module.py"
+    assert len(isfile_calls) == calls
+
+    # Changing sys.path or the working directory gives a fresh lookup
+    monkeypatch.syspath_prepend(str(tmp_path))
+    assert FrameInfo(frame_for(missing)).filename == "missing_module.py"
+    assert len(isfile_calls) > calls
+
+    monkeypatch.chdir(tmp_path.parent)
+    assert FrameInfo(frame_for(relative)).filename == str(tmp_path / "relative_module.py")
+
+
+def test_lazy_executing(monkeypatch):
+    def get_frame_info():
+        return FrameInfo(inspect.currentframe())
+
+    executing = Source.executing.__func__
+    calls = []
+
+    def recording_executing(cls, frame_or_tb):
+        calls.append(frame_or_tb)
+        return executing(cls, frame_or_tb)
+
+    monkeypatch.setattr(Source, "executing", classmethod(recording_executing))
+
+    frame_info = get_frame_info()
+    assert frame_info.filename == __file__
+    assert frame_info.code_qualname == "test_lazy_executing.<locals>.get_frame_info"
+    assert not calls
+
+    # The frame has finished, but the position when the FrameInfo was created is used
+    assert frame_info.executing.node.func.id == "FrameInfo"
+    assert frame_info.executing.frame is frame_info.frame
+    assert len(calls) == 1
+    assert frame_info.source is frame_info.executing.source
+
+
+def get_recursion_error():
+    def recurse(n):
+        if n == 0:
+            raise ValueError
+        recurse(n - 1)
+
+    try:
+        recurse(100)
+    except ValueError as e:
+        return e
+
+
 def sys_modules_sources():
     for module in list(sys.modules.values()):
         try:
@@ -506,7 +743,70 @@ def test_sys_modules():
 
     for source in modules:
         check_pieces(source)
+        check_scope_pieces_index(source)
+        check_tokens_by_lineno(source)
         check_pygments_tokens(source)
+        check_node_structure(source)
+
+
+def check_node_structure(source):
+    """
+    Grouping nodes by node_structure should give the same result
+    as reparsing their source text, which is what FrameInfo.variables used to do.
+    """
+    nodes = [
+        node
+        for node in ast.walk(source.tree)
+        if isinstance(node, (ast.expr, ast.arg))
+    ]
+
+    def get_text(n):
+        if isinstance(n, ast.arg):
+            return n.arg
+        return source.asttext().get_text(n)
+
+    def reparse_key(n):
+        text = get_text(n)
+        if not text:
+            return None
+        try:
+            parsed = ast.parse('(' + text + ')', mode='eval').body
+        except SyntaxError:
+            return None
+        # Since Python 3.12 the literal parts of f-strings are Constant nodes
+        # whose source text is just the raw characters, which reparse as something else
+        if not isinstance(parsed, ast.Name if isinstance(n, ast.arg) else type(n)):
+            return None
+        return ast.dump(parsed)
+
+    def groups(key_func):
+        return sorted(
+            [id(n) for n in group]
+            for key, group in group_by_key_func(nodes, key_func).items()
+            if key is not None
+        )
+
+    memo = {}
+    assert groups(reparse_key) == groups(
+        lambda n: reparse_key(n) and node_structure(n, memo)
+    )
+
+
+def test_node_structure():
+    for name in ["example", "formatter_example", "pieces", "pygments_example", "to_exec"]:
+        check_node_structure(Source.for_filename(samples_dir / (name + ".py")))
+
+    def structure(code):
+        return node_structure(ast.parse(code).body[0].value)
+
+    assert structure("x") == structure("(x)") == structure("(\n  x  # comment\n)")
+    assert structure("a.b[c]") == structure("a . b [ c ]")
+    assert structure("1") != structure("1.0") != structure("True")
+    assert structure("f(x)") != structure("f(y)")
+
+    target = ast.parse("x = 1").body[0].targets[0]
+    arg = ast.parse("def f(x: int): pass").body[0].args.args[0]
+    assert node_structure(target) == node_structure(arg) == structure("x")
 
 
 def check_pieces(source):
@@ -541,6 +841,64 @@ def check_pieces(source):
         assert not source.lines[lineno - 1].strip(), lineno
 
 
+def check_scope_pieces_index(source):
+    for node in ast.walk(source.tree):
+        if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            continue
+        scope_start, scope_end = source.line_range(node)
+        expected = [
+            piece
+            for piece in source.pieces
+            if scope_start <= piece.start and piece.stop <= scope_end
+        ]
+        assert list(source._clean_pieces(node)) == expected
+        pieces, starts = source._scope_pieces_index(node)
+        assert pieces == expected
+        assert starts == [piece.start for piece in expected]
+        assert source._scope_pieces_index(node)[0] is pieces
+
+
+def test_scope_pieces_index():
+    for filename in ["pieces.py", "example.py", "formatter_example.py"]:
+        filename = str(samples_dir / filename)
+        with open(filename) as f:
+            lines = f.read().splitlines(True)
+
+        # Split each scope lazily before the whole file has been split
+        # and check that it matches the whole file's pieces afterwards
+        source = Source(filename, lines)
+        for node in ast.walk(source.tree):
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                source._scope_pieces_index(node)
+        assert "pieces" not in source.__dict__
+        check_scope_pieces_index(source)
+
+
+def check_tokens_by_lineno(source):
+    index = TokenIndex.from_tokens(source.text, source.asttokens().tokens)
+    expected = group_by_key_func(source.asttokens().tokens, lambda tok: tok.start[0])
+    assert list(index) == sorted(expected)
+    assert len(index) == len(expected)
+    for lineno in range(len(source.lines) + 2):
+        assert index[lineno] == expected.get(lineno, [])
+        assert (lineno in index) == (lineno in expected)
+
+    state = TokenIndex.from_state(source.text, index.to_state())
+    assert dict(state) == dict(index)
+
+
+def test_tokens_by_lineno():
+    filename = str(samples_dir / "pieces.py")
+    with open(filename) as f:
+        source = Source(filename, f.read().splitlines(True))
+    assert isinstance(source.tokens_by_lineno, TokenIndex)
+    # The full ASTTokens object isn't kept
+    assert source._asttokens is None
+    assert source.tokens_by_lineno[2] is source.tokens_by_lineno[2]
+    assert source.tokens_by_lineno[10000] == []
+    check_tokens_by_lineno(source)
+
+
 def check_pygments_tokens(source):
     lexer = Python3Lexer(stripnl=False, ensurenl=False)
     pygments_tokens = [value for ttype, value in pygments.lex(source.text, lexer)]
@@ -554,6 +912,68 @@ def test_invalid_source():
     assert not hasattr(source, "tokens_by_lineno")
 
 
+def test_source_cache(monkeypatch):
+    cache = SourceCache(max_entries=2)
+    monkeypatch.setattr(Source, "cache", cache)
+    filenames = [str(samples_dir / name) for name in ["pieces.py", "example.py", "to_exec.py"]]
+
+    first = Source.for_filename(filenames[0])
+    assert Source.for_filename(filenames[0]) is first
+    assert (cache.hits, cache.misses, cache.evictions) == (1, 1, 0)
+
+    Source.for_filename(filenames[1])
+    Source.for_filename(filenames[0])
+    Source.for_filename(filenames[2])
+    # filenames[1] was the least recently used
+    assert (cache.hits, cache.misses, cache.evictions) == (2, 3, 1)
+    assert Source.for_filename(filenames[0]) is first
+    assert len(cache) == 2
+    assert "entries=2" in repr(cache)
+
+    cache.max_bytes = first._approximate_size()
+    Source.for_filename(filenames[0])
+    assert len(cache) == 1
+
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.total_bytes == 0
+    assert Source.for_filename(filenames[0]) is not first
+
+    # Sources of modules removed from sys.modules are evicted
+    module = types.ModuleType("stack_data_test_module")
+    monkeypatch.setitem(sys.modules, module.__name__, module)
+    source = Source.for_filename(filenames[1], module.__dict__)
+    assert Source.for_filename(filenames[1]) is source
+    del sys.modules[module.__name__]
+    cache.evict_unloaded_modules()
+    assert Source.for_filename(filenames[1]) is not source
+
+    # Evicted sources are also removed from the cache of executing
+    frame = inspect.currentframe()
+    source = Source.executing(frame).source
+    cache.clear()
+    assert Source.executing(frame).source is not source
+
+    # Subclasses get their own instances
+    class MySource(Source):
+        pass
+
+    cache.max_entries = cache.max_bytes = None
+
+    source = Source.for_filename(filenames[0])
+    my_source = MySource.for_filename(filenames[0])
+    assert type(my_source) is MySource
+    assert my_source is not source
+    assert MySource.for_filename(filenames[0]) is my_source
+    assert Source.for_filename(filenames[0]) is source
+
+    # Evicting a subclass's source also clears that subclass's executing cache
+    my_source = MySource.executing(frame).source
+    assert type(my_source) is MySource
+    cache.clear()
+    assert MySource.executing(frame).source is not my_source
+
+
 def test_absolute_filename():
     sys.path.append(str(samples_dir))
     short_filename = "to_exec.py"
@@ -579,12 +999,66 @@ def test_absolute_filename():
 )
 def test_executing_style_defs(expected):
     style = style_with_executing_node("native", "bg:#ffff00")
+    assert style_with_executing_node("native", "bg:#ffff00") is style
     formatter = HtmlFormatter(style=style)
     style_defs = formatter.get_style_defs()
 
     assert re.search(expected, style_defs)
 
 
+def test_pygmented_with_ranges():
+    formatter = HtmlFormatter(nowrap=True, style=style_with_executing_node("native", "bold"))
+    code = "foo(bar, baz)"
+    assert _pygmented_with_ranges(formatter, code, []) == [
+        '<span class="n">foo</span><span class="p">(</span><span class="n">bar</span>'
+        '<span class="p">,</span> <span class="n">baz</span><span class="p">)</span>'
+    ]
+    assert _pygmented_with_ranges(formatter, code, [(9, 12), (4, 7), (5, 6)]) == [
+        '<span class="n">foo</span><span class="p">(</span><span class="n n-ExecutingNode">bar</span>'
+        '<span class="p">,</span> <span class="n n-ExecutingNode">baz</span><span class="p">)</span>'
+    ]
+
+
+def test_pygmented_lines_cache():
+    style = style_with_executing_node("native", "bold")
+    options = Options(pygments_formatter=HtmlFormatter(style=style))
+
+    def foo(opts):
+        return FrameInfo(inspect.currentframe(), opts)
+
+    frame_infos = [foo(options), foo(options)]
+    first, second = [frame_info._pygmented_scope_lines for frame_info in frame_infos]
+    assert first == second
+    assert first[1] is second[1]
+    assert [line.render(pygmented=True) for line in frame_infos[0].lines] == \
+           [line.render(pygmented=True) for line in frame_infos[1].lines]
+
+    other = foo(Options(pygments_formatter=HtmlFormatter(style=style)))._pygmented_scope_lines
+    assert other == first
+    assert other[1] is not first[1]
+
+    # Only the displayed lines are highlighted,
+    # but they're the same as if the whole scope was highlighted
+    frame_info = FrameInfo(inspect.currentframe(), options)
+    scope_start = frame_info.source.line_range(frame_info.scope)[0]
+    start_line, lines = frame_info._pygmented_scope_lines
+    assert start_line == frame_info.included_pieces[0].start > scope_start
+    atext = frame_info.source.asttext()
+    node_start, node_end = atext.get_text_range(frame_info.executing.node)
+    offset = atext.get_text_range(frame_info.scope)[0]
+    whole_scope = _pygmented_with_ranges(
+        options.pygments_formatter,
+        atext.get_text(frame_info.scope),
+        [(node_start - offset, node_end - offset)],
+    )
+    assert lines == whole_scope[start_line - scope_start:][:len(lines)]
+
+    # Lines of the scope that aren't displayed can still be rendered
+    for lineno in [scope_start, scope_start + 1, start_line - 1]:
+        line = Line(frame_info, lineno)
+        assert line.render(pygmented=True, strip_leading_indent=False) == whole_scope[lineno - scope_start]
+
+
 def test_example():
     from .samples.example import bar
     result = bar()
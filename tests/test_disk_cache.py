@@ -0,0 +1,62 @@
+import marshal
+import os
+import shutil
+from pathlib import Path
+
+from stack_data import Source
+from stack_data.__main__ import main
+from stack_data.disk_cache import DiskCache, _source_key
+
+samples_dir = Path(__file__).parent / "samples"
+
+
+def fresh_source(filename):
+    with open(filename) as f:
+        return Source(filename, f.read().splitlines(True))
+
+
+def stored_key(path):
+    with open(path, "rb") as f:
+        return marshal.load(f)["key"]
+
+
+def test_disk_cache(tmp_path):
+    filename = str(tmp_path / "pieces.py")
+    shutil.copy(str(samples_dir / "pieces.py"), filename)
+    cache = DiskCache(str(tmp_path / "cache"))
+
+    expected = fresh_source(filename)
+    assert cache.warm([filename]) == 1
+    assert len(os.listdir(cache.directory)) == 1
+
+    source = fresh_source(filename)
+    source.disk_cache = cache
+    assert source.pieces == expected.pieces
+    assert dict(source.tokens_by_lineno) == dict(expected.tokens_by_lineno)
+    assert source._line_ranges
+    for node in source.tree.body:
+        assert source.line_range(node) == expected.line_range(node)
+
+    # Changing the file invalidates the entry
+    path = cache.path_for(filename)
+    old_key = _source_key(source)
+    with open(filename, "a") as f:
+        f.write("\nx = 1\n")
+    source = fresh_source(filename)
+    new_key = _source_key(source)
+    assert new_key != old_key
+    assert stored_key(path) == old_key
+    assert cache._load(source, path, new_key) is None
+    source.disk_cache = cache
+    assert source.pieces[-1] == range(len(source.lines), len(source.lines) + 1)
+    assert stored_key(path) == new_key
+
+    # Non-files and invalid Python aren't cached
+    assert cache.get(Source("<string>", ["x = 1\n"])) is None
+    assert cache.get(Source.for_filename(str(samples_dir / "not_code.txt"))) is None
+
+
+def test_warm_command(tmp_path, capsys):
+    assert main(["--cache-dir", str(tmp_path), "tests.samples"]) == 0
+    assert capsys.readouterr().out.startswith("Cached ")
+    assert len(os.listdir(str(tmp_path))) == len(list(samples_dir.glob("*.py")))
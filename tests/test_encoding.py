@@ -0,0 +1,39 @@
+import json
+
+import pytest
+
+from stack_data import Serializer
+from stack_data.encoding import encode, decode
+from tests.samples.exceptions import get_exception
+
+
+def test_round_trip():
+    for value in [
+        None, True, False, 0, 1, -1, 127, 128, -129, 2 ** 100, -(2 ** 100), 1.5, float("inf"),
+        "", "abc", "☃\ud800", [], {}, [1, "a", [None]], {"a": {"b": [1, 2.0]}, "c": "a"},
+    ]:
+        data = encode(value)
+        assert decode(data) == value
+        assert type(decode(data)) is type(value)
+
+    assert decode(encode((1, (2,)))) == [1, [2]]
+
+
+def test_serializer_output():
+    for serializer in [Serializer(show_variables=True), Serializer(pygmented=True, html=True)]:
+        result = serializer.format_exception(get_exception())
+        data = encode(result)
+        assert decode(data) == result
+        assert len(data) < len(json.dumps(result)) / 2
+
+
+def test_errors():
+    with pytest.raises(TypeError):
+        encode({1: 2})
+    with pytest.raises(TypeError):
+        encode([object()])
+
+    data = encode({"a": [1.5, "b"]})
+    for invalid in [b"", b"{}", data[:-1], data[:-3], data + b"\x00", data[:-1] + b"\x09"]:
+        with pytest.raises(ValueError):
+            decode(invalid)
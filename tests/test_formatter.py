@@ -8,6 +8,7 @@ import pytest
 from asttokens.util import fstring_positions_work
 
 from stack_data import Formatter, FrameInfo, Options, BlankLines
+from tests.samples.exceptions import get_exceptions, recurse
 from tests.utils import compare_to_file
 
 
@@ -166,3 +167,87 @@ def test_invalid_single_option():
     with pytest.raises(ValueError):
         MyFormatter(show_linenos=False, options=Options(blank_lines=BlankLines.SINGLE))
 
+
+def test_format_exceptions():
+    exceptions = get_exceptions()
+
+    class CountingFormatter(Formatter):
+        share_frame_layouts = True
+        lines_formatted = 0
+
+        def format_line(self, line) -> str:
+            self.lines_formatted += 1
+            return super().format_line(line)
+
+    formatter = CountingFormatter(show_variables=True)
+    separately = ["".join(formatter.format_exception(e)) for e in exceptions]
+    count = formatter.lines_formatted
+
+    formatter.lines_formatted = 0
+    assert formatter.format_exceptions(exceptions) == separately
+    assert formatter.lines_formatted == count / 3
+    assert "x = 2\n" in separately[2]
+
+    tb = exceptions[0].__traceback__
+    assert formatter.format_exceptions([tb]) == ["".join(formatter.format_stack(tb))]
+
+
+def test_overridden_frame_layout():
+    class LocalsFormatter(Formatter):
+        def format_frame_header(self, frame_info: FrameInfo) -> str:
+            n = frame_info.frame.f_locals.get("n")
+            return super().format_frame_header(frame_info).rstrip() + " n={}\n".format(n)
+
+    try:
+        recurse(3)
+    except ValueError as e:
+        exception = e
+
+    formatter = LocalsFormatter(collapse_repeated_frames=False)
+    for result in [
+        "".join(formatter.format_exception(exception)),
+        formatter.format_exceptions([exception])[0],
+    ]:
+        assert re.findall(r"in recurse n=(\d)", result) == ["3", "2", "1", "0"]
+
+    # The first three frames are at the same position, so opting in shares the header
+    LocalsFormatter.share_frame_layouts = True
+    result = "".join(formatter.format_exception(exception))
+    assert re.findall(r"in recurse n=(\d)", result) == ["3", "3", "3", "0"]
+
+
+def test_abandoned_generator():
+    def fail(value):
+        raise ValueError
+
+    value = [1]
+    try:
+        fail(value)
+    except ValueError as e:
+        exception = e
+
+    formatter = Formatter(show_variables=True)
+    lines = formatter.format_exception(exception)
+    next(lines)
+    assert formatter._repr_memo.current is None
+    assert formatter._frame_layouts.current is None
+
+    # A new call doesn't reuse the reprs remembered by the suspended generator
+    value.append(2)
+    assert "value = [1, 2]\n" in "".join(formatter.format_exception(exception))
+    assert "value = [1, 2]\n" in "".join(lines)
+
+
+def test_format_exceptions_while_suspended():
+    exceptions = get_exceptions()
+    formatter = Formatter(show_variables=True)
+    lines = formatter.format_exception(exceptions[0])
+    for _ in range(3):
+        next(lines)
+
+    # The batch doesn't share the scopes of the suspended generator, or leave its own open
+    assert formatter.format_exceptions(exceptions) == [
+        "".join(formatter.format_exception(e)) for e in exceptions
+    ]
+    assert formatter._repr_memo.current is None
+    assert formatter._frame_layouts.current is None
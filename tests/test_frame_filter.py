@@ -0,0 +1,85 @@
+import inspect
+import json
+
+import pytest
+
+from stack_data import FrameInfo, FrameFilter, HiddenFrames, Formatter, Serializer, Source
+
+
+def hook(_):
+    raise ValueError("from hook")
+
+
+def get_exception():
+    try:
+        json.loads('{"a": 1}', object_hook=hook)
+    except ValueError as e:
+        return e
+
+
+def filenames(stack):
+    return [
+        [tb.tb_frame.f_code.co_filename for tb in item.frames]
+        if isinstance(item, HiddenFrames)
+        else item.code.co_name
+        for item in stack
+    ]
+
+
+@pytest.mark.parametrize("frame_filter", [
+    FrameFilter(stdlib=True),
+    FrameFilter(modules=["json"]),
+    FrameFilter(paths=["*/json/*.py"]),
+    FrameFilter(paths=[json.__path__[0]]),
+])
+def test_hidden_frames(frame_filter, monkeypatch):
+    e = get_exception()
+
+    executing = Source.executing.__func__
+    analysed = []
+
+    def recording_executing(cls, frame_or_tb):
+        analysed.append(frame_or_tb.tb_frame.f_code.co_filename)
+        return executing(cls, frame_or_tb)
+
+    monkeypatch.setattr(Source, "executing", classmethod(recording_executing))
+
+    stack = list(FrameInfo.stack_data(e.__traceback__, frame_filter=frame_filter))
+    result = filenames(stack)
+    assert result[0] == "get_exception"
+    assert result[-1] == "hook"
+    assert len(result) == 3
+    assert all("json" in filename for filename in result[1])
+    for item in stack:
+        if isinstance(item, FrameInfo):
+            assert item.lines
+    # Only the frames that are shown were analysed
+    assert analysed == [__file__, __file__]
+
+    assert "\n    [... {} frames hidden]\n".format(len(result[1])) in "".join(
+        Formatter(frame_filter=frame_filter).format_exception(e)
+    )
+    frames = Serializer(frame_filter=frame_filter).format_exception(e)[0]["frames"]
+    assert frames[1] == dict(type="hidden_frames", count=len(result[1]))
+
+
+def test_site_packages():
+    frame = inspect.currentframe()
+    site_packages_frames = [
+        f for f in FrameInfo.stack_data(frame, collapse_repeated_frames=False)
+        if "site-packages" in f.filename
+    ]
+    if not site_packages_frames:
+        pytest.skip("pytest isn't installed in site-packages")
+
+    stack = list(FrameInfo.stack_data(frame, frame_filter=FrameFilter(site_packages=True)))
+    assert isinstance(stack[-2], HiddenFrames)
+    assert stack[-1].frame is frame
+    assert not any(
+        "site-packages" in item.filename
+        for item in stack
+        if isinstance(item, FrameInfo)
+    )
+
+    # The standard library filter doesn't include site-packages
+    assert FrameFilter(stdlib=True)(site_packages_frames[0].frame)
@@ -1,8 +1,12 @@
+import inspect
+import json
 import os.path
 import re
+from io import StringIO
 
 from stack_data import FrameInfo
 from stack_data.serializing import Serializer
+from tests.samples.exceptions import get_exception, get_exceptions, recurse
 from tests.utils import compare_to_file_json
 
 
@@ -40,3 +44,101 @@ def test_example():
 
 
     compare_to_file_json(result, "serialize", pygmented=True)
+
+
+def test_format_exceptions():
+    exceptions = get_exceptions()
+
+    serializer = Serializer(show_variables=True)
+    result = serializer.format_exceptions(exceptions)
+    assert result == [serializer.format_exception(e) for e in exceptions]
+
+    # Frames share their layout but not the dicts in the result
+    frames = [r[0]["frames"][-1] for r in result]
+    assert frames[0]["lines"] == frames[1]["lines"]
+    assert frames[0]["lines"] is not frames[1]["lines"]
+    assert frames[0]["lines"][0] is not frames[1]["lines"][0]
+    assert [v["value"] for v in frames[1]["variables"] if v["name"] == "x"] == ["1"]
+
+
+def test_overridden_frame_layout():
+    class LocalsSerializer(Serializer):
+        def format_lines(self, lines):
+            for line in super().format_lines(lines):
+                line["n"] = lines[0].frame_info.frame.f_locals.get("n")
+                yield line
+
+    try:
+        recurse(3)
+    except ValueError as e:
+        exception = e
+
+    serializer = LocalsSerializer(collapse_repeated_frames=False)
+    frames = serializer.format_exception(exception)[0]["frames"]
+    assert [frame["lines"][0]["n"] for frame in frames[1:]] == [3, 2, 1, 0]
+
+
+def test_streaming():
+    from .samples.formatter_example import bar
+
+    serializers = [
+        MyFormatter(),
+        MyFormatter(show_variables=True, pygmented=True),
+        MyFormatter(show_variables=True, reference_repeated_values=True),
+        MyFormatter(chain=False, collapse_repeated_frames=False),
+    ]
+
+    for serializer in serializers:
+        e = get_exception()
+        expected = json.dumps(serializer.format_exception(e))
+        assert "".join(serializer.iter_exception_json(e)) == expected
+        file = StringIO()
+        serializer.dump_exception(e, file=file)
+        assert file.getvalue() == expected
+
+        try:
+            bar()
+        except Exception:
+            expected = json.dumps(serializer.format_exception())
+            pieces = serializer.iter_exception_json()
+        assert "".join(pieces) == expected
+
+        frame = inspect.currentframe()
+        expected = json.dumps(serializer.format_stack(frame))
+        assert "".join(serializer.iter_stack_json(frame)) == expected
+        file = StringIO()
+        serializer.dump_stack(frame, file=file)
+        assert file.getvalue() == expected
+
+
+def test_streaming_memo():
+    class MemoSerializer(Serializer):
+        def format_variable(self, var):
+            memos.append(dict(self._repr_memo.current))
+            return super().format_variable(var)
+
+    try:
+        recurse(3)
+    except ValueError as e:
+        exception = e
+
+    for reference_repeated_values in [False, True]:
+        memos = []
+        serializer = MemoSerializer(show_variables=True, reference_repeated_values=reference_repeated_values)
+        expected = serializer.format_exception(exception)
+        assert memos[-1]
+
+        memos = []
+        pieces = list(serializer.iter_exception_json(exception))
+        assert memos
+        for entries in memos:
+            if reference_repeated_values:
+                assert all(entry.text is None for entry in entries.values())
+            else:
+                assert not entries
+        abandoned = serializer.iter_exception_json(exception)
+        next(abandoned)
+        next(abandoned)
+        assert serializer._repr_memo.current is None
+        # The variables of this test's frame have changed in the meantime
+        assert json.loads("".join(pieces))[0]["frames"][1:] == expected[0]["frames"][1:]
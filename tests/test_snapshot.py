@@ -0,0 +1,48 @@
+import pickle
+
+from stack_data import Formatter, Serializer, ExceptionSnapshot, FrameSnapshot, FrameInfo
+from tests.samples.exceptions import get_exception
+
+
+def test_snapshot_rendering():
+    e = get_exception()
+    snapshot = pickle.loads(pickle.dumps(ExceptionSnapshot(e)))
+
+    assert snapshot.type_name == "ZeroDivisionError"
+    assert snapshot.__context__.type_name == "ValueError"
+    assert snapshot.__context__.message == "boom"
+    assert len(snapshot.__context__.frames) == 7
+
+    for formatter in [Formatter(), Formatter(pygmented=True), Serializer()]:
+        assert list(formatter.format_exception(snapshot)) == list(formatter.format_exception(e))
+
+
+def test_snapshot_variables():
+    e = get_exception()
+    snapshot = pickle.loads(pickle.dumps(ExceptionSnapshot(e)))
+    frame = snapshot.__context__.__traceback__
+    assert frame.f_back is snapshot.__context__.frames[-2]
+
+    frame_info = FrameInfo(frame)
+    assert FrameInfo(frame.f_back).executing.node is not None
+    assert [(var.name, repr(var.value)) for var in sorted(frame_info.variables)] == [
+        ("lst", "[0, 0, 0]"),
+        ("n", "0"),
+    ]
+
+    # Frames of the same function share a code object after unpickling
+    assert frame.f_code is frame.f_back.f_code
+
+    without_variables = ExceptionSnapshot(e, variables=False)
+    assert without_variables.__context__.__traceback__.f_locals == {}
+
+
+def test_frame_snapshot():
+    import inspect
+
+    frame = inspect.currentframe()
+    snapshot = pickle.loads(pickle.dumps(FrameSnapshot.from_frame(frame)))
+    assert snapshot.f_lineno == frame.f_lineno - 1
+    assert snapshot.f_code.co_name == "test_frame_snapshot"
+    assert "inspect" not in snapshot.f_locals  # modules aren't interesting
+    assert repr(snapshot.f_locals["frame"]).startswith("<frame at ")
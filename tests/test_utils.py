@@ -2,12 +2,15 @@ import random
 from collections import Counter
 
 from stack_data import FrameInfo
-from stack_data.utils import highlight_unique, collapse_repeated, cached_property
+from stack_data.utils import highlight_unique, collapse_repeated, collapse_repeated_streaming, cached_property
 
 
 def assert_collapsed(lst, expected, summary):
     assert ''.join(collapse_repeated(lst, collapser=lambda group, _: '.' * len(group))) == expected
     assert list(collapse_repeated(lst, collapser=lambda group, _: Counter(group))) == summary
+    assert list(collapse_repeated_streaming(
+        lst, collapser=lambda group, _: Counter(group), window=len(lst),
+    )) == summary
 
 
 def test_collapse_repeated():
@@ -46,3 +49,64 @@ def test_highlight_unique_properties():
 def test_cached_property_from_class():
     assert FrameInfo.filename is FrameInfo.__dict__["filename"]
     assert isinstance(FrameInfo.filename, cached_property)
+
+
+def test_highlight_unique_matches_quadratic_version():
+    def highlight_unique_quadratic(lst):
+        counts = Counter(lst)
+        result = [True] * len(lst)
+        start = 0
+        for i in range(len(lst) + 1):
+            if i < len(lst) and (counts[lst[i]] > 3) == (counts[lst[start]] > 3):
+                continue
+            if counts[lst[start]] > 3:
+                group = lst[start:i]
+                result[start:i] = [False] * len(group)
+                for item in set(group):
+                    indices = [j for j, x in enumerate(group) if x == item]
+                    for j in indices[:2] + indices[-1:]:
+                        result[start + j] = True
+            start = i
+        return list(zip(lst, result))
+
+    for _ in range(20):
+        lst = [random.choice('ABCDEFGHIJ') for _ in range(random.randrange(500))]
+        lst += list('0123456789')
+        random.shuffle(lst)
+        assert list(highlight_unique(lst)) == highlight_unique_quadratic(lst)
+
+
+def test_collapse_repeated_streaming():
+    def collapser(group, keys):
+        return tuple(group)
+
+    for _ in range(100):
+        lst = [random.choice('ABCDEFGH'[:random.randint(1, 8)]) for _ in range(random.randrange(300))]
+        assert (
+            list(collapse_repeated_streaming(lst, collapser=collapser, window=len(lst))) ==
+            list(collapse_repeated(lst, collapser=collapser))
+        )
+
+        # With a small window, everything is still yielded exactly once in order
+        result = collapse_repeated_streaming(lst, collapser=collapser, window=random.randint(1, 20))
+        flattened = []
+        for x in result:
+            flattened.extend(x if isinstance(x, tuple) else [x])
+        assert flattened == lst
+
+
+def test_collapse_repeated_streaming_is_lazy():
+    consumed = 0
+
+    def recursion():
+        nonlocal consumed
+        yield 'main'
+        for _ in range(10000):
+            consumed += 1
+            yield 'f'
+            yield 'g'
+
+    result = collapse_repeated_streaming(recursion(), collapser=lambda group, _: len(group), window=10)
+    assert next(result) == 'main'
+    assert consumed <= 10
+    assert list(result) == ['f', 'g', 'f', 'g', 19994, 'f', 'g']
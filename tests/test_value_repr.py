@@ -0,0 +1,211 @@
+import sys
+import threading
+import time
+from collections import defaultdict, Counter, OrderedDict, deque, namedtuple
+
+import pytest
+
+from stack_data import Formatter, Serializer, Variable
+from stack_data.value_repr import ValueRepr
+
+
+def test_small_values_unchanged():
+    value_repr = ValueRepr()
+    for value in [
+        1, 2.5, None, True, "abc", b"abc", bytearray(b"abc"),
+        [1, (2,), {3: "4"}], {"b": 1, "a": 2}, {3, 1, 2}, frozenset([1]),
+        set(), frozenset(), {}, (), [], defaultdict(int, a=1), Counter("aab"),
+    ]:
+        assert value_repr(value) == repr(value)
+
+
+class MyList(list):
+    pass
+
+
+class MyDict(dict):
+    pass
+
+
+class MySet(set):
+    pass
+
+
+class MyFrozenSet(frozenset):
+    pass
+
+
+class MyDeque(deque):
+    pass
+
+
+Point = namedtuple("Point", "x y")
+
+
+def test_container_subclasses():
+    value_repr = ValueRepr()
+    for value in [
+        MyList([1, [2]]), MyDict(a=[1]), MySet([1]), MySet(), MyFrozenSet([2]), MyFrozenSet(),
+        MyDeque([1, 2]), MyDeque([1], maxlen=3), deque([1], maxlen=2), Point(1, [2]),
+        defaultdict(list, a=[1]), defaultdict(None), Counter(), Counter({1: 2, "a": "b"}),
+        OrderedDict(), OrderedDict(a=1, b=[2]),
+    ]:
+        assert value_repr(value) == repr(value)
+
+    # Nested values are bounded
+    value_repr = ValueRepr(max_items=2, time_budget=1)
+    big = list(range(10 ** 6))
+    assert value_repr(defaultdict(list, a=big)) == "defaultdict(<class 'list'>, {'a': [0, 1, ...]})"
+    assert value_repr(Counter({"a": 3, "b": 5, "c": 1})) == "<Counter with 3 items>"
+    value_repr.summarizers = []
+    assert value_repr(Counter({"a": 3, "b": 5, "c": 1})) == "Counter({'b': 5, 'a': 3, ...})"
+    assert value_repr(OrderedDict(a=big)) in [
+        "OrderedDict({'a': [0, 1, ...]})",
+        "OrderedDict([('a', [0, 1, ...])])",
+    ]
+    assert value_repr(MyList([big])) == "[[0, 1, ...]]"
+    assert value_repr(Point(big, 1)) == "Point(x=[0, 1, ...], y=1)"
+
+    class CustomRepr(list):
+        def __repr__(self):
+            return "custom"
+
+    assert value_repr(CustomRepr()) == "custom"
+
+
+def test_large_values():
+    value_repr = ValueRepr(max_length=50, max_items=3, max_depth=2)
+
+    assert value_repr(list(range(10 ** 6))) == "[0, 1, 2, ...]"
+    assert value_repr({i: i for i in range(10)}) == "{0: 0, 1: 1, 2: 2, ...}"
+    assert value_repr(set(range(10))) == "{0, 1, 2, ...}"
+    assert value_repr([[[[1]]]]) == "[[[...]]]"
+    assert value_repr("x" * 1000) == "'" + "x" * 22 + "..." + "x" * 23 + "'"
+    assert value_repr(b"a" * 10 ** 7) == "b'" + "a" * 22 + "..." + "a" * 22 + "'"
+    assert value_repr(bytearray(b"a" * 1000)) == "bytearray(b'" + "a" * 12 + "..." + "a" * 21 + "')"
+    assert value_repr(defaultdict(int, {i: i for i in range(10)})) == "<defaultdict with 10 items>"
+    assert len(value_repr(["y" * 30] * 3)) == 50
+
+    if hasattr(sys, "set_int_max_str_digits"):
+        assert value_repr(10 ** 10000) == "<int with 33220 bits>"
+
+
+class FakeArray:
+    dtype = "float64"
+
+    def __init__(self, shape):
+        self._shape = shape
+
+    @property
+    def shape(self):
+        return self._shape
+
+    def __repr__(self):
+        return "FakeArray({})".format(self.shape)
+
+
+def test_array_summary():
+    value_repr = ValueRepr(max_items=10)
+    assert value_repr(FakeArray((2, 5))) == "FakeArray((2, 5))"
+    assert value_repr(FakeArray((1000, 1000))) == "<FakeArray shape=(1000, 1000) dtype=float64>"
+
+
+def test_custom_summarizer():
+    value_repr = ValueRepr()
+    value_repr.summarizers.append(lambda r, x: "<array>" if isinstance(x, FakeArray) else None)
+    assert value_repr([FakeArray(())]) == "[<array>]"
+
+
+def test_time_budget():
+    class Slow:
+        def __repr__(self):
+            import time
+            time.sleep(0.02)
+            return "Slow()"
+
+    assert ValueRepr(time_budget=0.01)([Slow(), Slow(), Slow()]) == "[Slow(), ..., ...]"
+
+
+def test_time_budget_threads():
+    value_repr = ValueRepr(time_budget=0.1)
+    started = threading.Event()
+    other_done = threading.Event()
+
+    class Waiter:
+        def __repr__(self):
+            started.set()
+            other_done.wait(5)
+            time.sleep(0.15)
+            return "Waiter()"
+
+    results = []
+    thread = threading.Thread(target=lambda: results.append(value_repr([Waiter(), 1, 2])))
+    thread.start()
+    started.wait(5)
+
+    # Rendering another value at the same time doesn't change the deadline of the first
+    assert value_repr([3]) == "[3]"
+    other_done.set()
+    thread.join()
+    assert results == ["[Waiter(), ..., ...]"]
+
+
+def test_repr_errors_propagate():
+    class Broken:
+        def __repr__(self):
+            raise ValueError
+
+    with pytest.raises(ValueError):
+        ValueRepr()([Broken()])
+
+
+def test_formatter_and_serializer():
+    var = Variable("x", (), list(range(1000)))
+    value_repr = ValueRepr(max_items=2)
+    assert Formatter(value_repr=value_repr).format_variable(var) == "x = [0, 1, ...]"
+    assert Serializer(value_repr=value_repr).format_variable(var) == dict(name="x", value="[0, 1, ...]")
+
+
+class Counted:
+    calls = 0
+
+    def __repr__(self):
+        Counted.calls += 1
+        return "Counted()"
+
+
+def recurse(obj, n):
+    if n == 0:
+        raise ValueError
+    recurse(obj, n - 1)
+
+
+def test_repr_memo():
+    obj = Counted()
+    Counted.calls = 0
+    try:
+        recurse(obj, 5)
+    except ValueError as e:
+        formatted = "".join(Formatter(show_variables=True, collapse_repeated_frames=False).format_exception(e))
+        assert formatted.count("\nobj = Counted()\n") == 7
+        assert Counted.calls == 1
+
+        serializer = Serializer(show_variables=True, collapse_repeated_frames=False,
+                                reference_repeated_values=True)
+        frames = serializer.format_exception(e)[0]["frames"]
+        assert Counted.calls == 2
+
+    variables = [
+        [var for var in frame["variables"] if var["name"] == "obj"][0]
+        for frame in frames
+    ]
+    assert len(variables) == 7
+    value_id = variables[0]["value_id"]
+    assert variables[0] == dict(name="obj", value_id=value_id, value="Counted()")
+    assert variables[1:] == [dict(name="obj", value_id=value_id)] * 6
+
+    # Outside format_exception/format_stack nothing is memoized
+    formatter = Formatter()
+    formatter.format_variable_value(obj)
+    formatter.format_variable_value(obj)
+    assert Counted.calls == 4